@@ -0,0 +1,124 @@
+import db
+
+import os
+import hashlib
+import tempfile
+import threading
+import Queue
+import urllib2
+
+# preferred tmdb image sizes for each kind of artwork, best first
+sizes = {
+    'poster': [ 'mid', 'original', 'cover', 'thumb' ],
+    'fanart': [ 'original', 'poster', 'thumb' ],
+}
+# the tmdb image type each kind of artwork is taken from
+types = {
+    'poster': 'poster',
+    'fanart': 'backdrop',
+}
+# file names in the movie directories, and the kind of artwork they show
+filenames = {
+    'poster.jpg': 'poster',
+    'fanart.jpg': 'fanart',
+}
+
+def storepath(store, digest):
+    return os.path.join(store, digest[:2], digest + '.jpg')
+
+def choose(images):
+    """ Picks the url of each kind of artwork from a tmdb ImagesList. """
+    chosen = { }
+    for kind in sizes:
+        for image in images.find_by('type', types[kind]):
+            for size in sizes[kind]:
+                if size in image:
+                    chosen[kind] = image[size]
+                    break
+            if kind in chosen:
+                break
+    return chosen
+
+class Downloader(object):
+    """
+      Downloads artwork into a content addressed store, where each image is
+      named by the sha1 of its contents. Images with a url that is already
+      known are not downloaded again, and identical images from different
+      urls are only stored once.
+
+      Downloads run in a fixed number of worker threads, add() blocks once
+      too many are pending. Only finish() touches the database, so this can
+      run alongside an ingest in the main thread.
+    """
+
+    def __init__(self, store, workers=4):
+        self.store = store
+        self.queue = Queue.Queue(workers * 4)
+        # (movie id, kind, url, digest) of everything that is in the store
+        self.results = [ ]
+        # (url, error) of failed downloads
+        self.errors = [ ]
+        self.threads = [ ]
+        for i in range(workers):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def add(self, movie_id, images):
+        for kind, url in choose(images).iteritems():
+            known = db.session.query(db.Artwork.digest).filter_by(url=url).first()
+            if known is not None and os.path.exists(storepath(self.store, known[0])):
+                self.results.append((movie_id, kind, url, known[0]))
+            else:
+                self.queue.put((movie_id, kind, url))
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            movie_id, kind, url = job
+            try:
+                self.results.append((movie_id, kind, url, self.download(url)))
+            except Exception, e:
+                # httplib's errors are no IOErrors, and a dead worker would
+                # leave add() and finish() waiting on the queue forever
+                self.errors.append((url, e))
+
+    def download(self, url):
+        response = urllib2.urlopen(url, timeout=60)
+        try:
+            # an answer without headers, like HTTP/0.9 garbage, is text/plain
+            if response.getcode() != 200 or not response.info().gettype().startswith('image/'):
+                raise IOError("not an image: status %s, %s" % (response.getcode(), response.info().gettype()))
+            data = response.read()
+        finally:
+            response.close()
+        digest = hashlib.sha1(data).hexdigest()
+        path = storepath(self.store, digest)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    # another worker was faster
+                    pass
+            # write under a temporary name, so the store never has partial files
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path)
+        return digest
+
+    def finish(self):
+        """ Waits for all downloads and records them. Returns the number of stored images. """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        for movie_id, kind, url, digest in self.results:
+            db.Artwork.set(movie_id, kind, url, digest)
+        db.session.commit()
+        return len(self.results)
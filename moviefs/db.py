@@ -1,14 +1,147 @@
-from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime
-from sqlalchemy import or_, func
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Index, UniqueConstraint
+from sqlalchemy import and_, or_, func, event, inspect, case, bindparam, text
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship, subqueryload, Query
+from sqlalchemy.ext import baked
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.sql.expression import ClauseElement
 
 from datetime import datetime
-
-engine = create_engine('sqlite:///movies.db') # echo=True)
-Session = sessionmaker(bind=engine)
-session = Session()
+from xml.sax.saxutils import escape
+import os
+import re
+import json
+import threading
+import Queue
+
+# the database file, change with configure() before the first query
+path = 'movies.db'
+# whether connections may only read, as for the mount
+readonly = False
+# created on first use, by getEngine()
+engine = None
+
+# page cache per connection in KiB, and how much of the file to mmap
+cache_size = 16384
+mmap_size = 256 << 20
+
+def configure(dbpath, ro=False):
+    global path, readonly
+    if engine is not None:
+        raise RuntimeError("database is in use already")
+    path = dbpath
+    readonly = ro
+
+def setupConnection(dbapi_conn, record):
+    """
+      Tunes every new connection. Writers put the database into WAL mode,
+      where readers never wait for a writer's commit and the other way
+      round, so ingesting while the filesystem is mounted works.
+    """
+    cursor = dbapi_conn.cursor()
+    if readonly:
+        cursor.execute('PRAGMA query_only = ON')
+    else:
+        cursor.execute('PRAGMA journal_mode = WAL')
+        # safe in WAL mode, only the last commits may be lost on power failure
+        cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.execute('PRAGMA cache_size = -%d' % cache_size)
+    cursor.execute('PRAGMA mmap_size = %d' % mmap_size)
+    cursor.close()
+
+def getEngine():
+    global engine
+    if engine is None:
+        engine = create_engine('sqlite:///' + path) # echo=True)
+        event.listen(engine, 'connect', setupConnection)
+        event.listen(engine, 'before_cursor_execute', countQuery)
+    return engine
+
+Session = sessionmaker()
+def newSession():
+    return Session(bind=getEngine())
+# the session of the current thread, only connects when it is first used
+session = scoped_session(newSession)
+
+# statements sent to the database, by any session
+query_stats = { 'queries': 0 }
+def countQuery(conn, cursor, statement, parameters, context, executemany):
+    query_stats['queries'] += 1
+
+class Statement(object):
+    """
+      A query of a fixed shape, compiled to sql on first use only. It runs
+      straight on the dbapi connection of the current session, which keeps
+      it prepared, and rows come back as plain tuples, no ORM involved.
+      Parameters are the query's bindparams, passed by name.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.sql = None
+
+    def rows(self, **params):
+        if self.sql is None:
+            compiled = getattr(self.query, 'statement', self.query).compile(dialect=getEngine().dialect)
+            self.names = compiled.positiontup or [ ]
+            self.defaults = compiled.params
+            self.sql = unicode(compiled)
+        values = dict(self.defaults)
+        values.update(params)
+        query_stats['queries'] += 1
+        cursor = session.connection().connection.cursor()
+        try:
+            cursor.execute(self.sql, [ values[x] for x in self.names ])
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+# compiles ORM queries once, for those that need to load objects
+bakery = baked.bakery()
+
+class SingleFlight(object):
+    """
+      Coalesces concurrent cache misses. Of all threads missing the same key
+      at the same time, only the first runs compute, which also puts the
+      result into cache, the others wait for it and share its result, or
+      its exception. A key already in cache by then is simply returned.
+
+      coalesced counts the computations, and so the queries, that were
+      saved this way.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> [ threading.Event, result, exception ] of the computation in flight
+        self.flights = { }
+        self.coalesced = 0
+
+    def do(self, cache, key, compute):
+        with self.lock:
+            if key in cache:
+                self.coalesced += 1
+                return cache[key]
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = [ threading.Event(), None, None ]
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight[0].wait()
+            if flight[2] is not None:
+                raise flight[2]
+            return flight[1]
+        try:
+            flight[1] = compute()
+            return flight[1]
+        except Exception, e:
+            flight[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight[0].set()
 
 Base = declarative_base()
 
@@ -39,6 +172,17 @@ movie_genres = Table('movie_genres', Base.metadata,
     Column('movie_id', Integer, ForeignKey('movies.id'))
 )
 
+movie_languages = Table('movie_languages', Base.metadata,
+    Column('language_id', Integer, ForeignKey('languages.id')),
+    Column('movie_id', Integer, ForeignKey('movies.id'))
+)
+
+# the facets of the mount list the movies of one criteria at a time, while
+# loading movies and the catalogue look up the criteria of movies
+for table in [ movie_actors, movie_directors, movie_genres, movie_languages ]:
+    Index('ix_%s_%s' % (table.name, table.c.keys()[0]), table.c.values()[0], table.c.movie_id)
+    Index('ix_%s_movie_id' % table.name, table.c.movie_id, table.c.values()[0])
+
 class Director(Base):
     __tablename__ = 'directors'
 
@@ -88,34 +232,196 @@ class Genre(Base):
     def __repr__(self):
        return "<Genre('%s')>" % (self.name)
 
+class Root(Base):
+    """ A library root, the directory the paths of its movies are relative to. """
+    __tablename__ = 'roots'
+
+    id = Column(Integer, primary_key=True)
+    path = Column(String(256), unique=True)
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_or_create(path):
+        root, _ = get_or_create(Root, path = path)
+        return root
+    get_or_create = staticmethod(get_or_create)
+
+    def __repr__(self):
+       return "<Root('%s')>" % (self.path)
+
+class Language(Base):
+    """ An audio language, by its three letter code. """
+    __tablename__ = 'languages'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(8), unique=True)
+
+    def __init__(self, name):
+        self.name = name
+
+    def get_or_create(name):
+        lang, _ = get_or_create(Language, name = name)
+        return lang
+    get_or_create = staticmethod(get_or_create)
+
+    def __repr__(self):
+       return "<Language('%s')>" % (self.name)
+
+class Artwork(Base):
+    __tablename__ = 'artwork'
+
+    movie_id = Column(Integer, ForeignKey('movies.id'), primary_key=True)
+    kind = Column(String(16), primary_key=True)
+    url = Column(String(256), index=True)
+    # sha1 of the image, which is its name in the artwork store
+    digest = Column(String(40))
+
+    def __init__(self, movie_id, kind, url, digest):
+        self.movie_id = movie_id
+        self.kind = kind
+        self.url = url
+        self.digest = digest
+
+    def set(movie_id, kind, url, digest):
+        art, created = get_or_create(Artwork, movie_id = movie_id, kind = kind, defaults={ 'url': url, 'digest': digest })
+        if not created:
+            art.url = url
+            art.digest = digest
+        return art
+    set = staticmethod(set)
+
+    def __repr__(self):
+       return "<Artwork('%s','%s')>" % (self.kind, self.digest)
+
+class FileHash(Base):
+    """ Opensubtitles hash of a file, valid as long as its size and mtime match. """
+    __tablename__ = 'file_hashes'
+
+    path = Column(String(256), primary_key=True)
+    size = Column(Integer)
+    mtime = Column(Integer)
+    hash = Column(String(16))
+
+    def __init__(self, path, size, mtime, hash):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.hash = hash
+
+    def set(path, size, mtime, hash):
+        fh, created = get_or_create(FileHash, path = path, defaults={ 'size': size, 'mtime': mtime, 'hash': hash })
+        if not created:
+            fh.size = size
+            fh.mtime = mtime
+            fh.hash = hash
+        return fh
+    set = staticmethod(set)
+
+class Review(Base):
+    """ A file that could not be matched automatically, waiting for a decision. """
+    __tablename__ = 'review_queue'
+
+    path = Column(String(256), primary_key=True)
+    guessname = Column(String(128))
+    # json encoded probe attributes and search results
+    attrs = Column(String)
+    candidates = Column(String)
+    added = Column(DateTime)
+
+    def __init__(self, path, guessname, attrs, candidates):
+        self.path = path
+        self.guessname = guessname
+        self.attrs = json.dumps(attrs)
+        self.candidates = json.dumps(candidates)
+        self.added = datetime.now()
+
+    def set(path, guessname, attrs, candidates):
+        """ Queues a file for review, or updates its entry with new candidates. """
+        instance = session.query(Review).filter_by(path = path).first()
+        if instance is None:
+            instance = Review(path, guessname, attrs, candidates)
+            session.add(instance)
+        else:
+            instance.guessname = guessname
+            instance.attrs = json.dumps(attrs)
+            instance.candidates = json.dumps(candidates)
+        return instance
+    set = staticmethod(set)
+
+    def __repr__(self):
+       return "<Review('%s')>" % (self.path)
+
+class SearchCache(Base):
+    """ A tmdb search result, remembered by the (normalized) title searched for. """
+    __tablename__ = 'search_cache'
+
+    query = Column(String(128), primary_key=True)
+    # 0 marks a search without results
+    movie_id = Column(Integer, primary_key=True)
+    name = Column(String(60))
+    released = Column(String(10))
+
+    def __init__(self, query, movie_id, name, released):
+        self.query = query
+        self.movie_id = movie_id
+        self.name = name
+        self.released = released
+
+def resolutionOf(width, height):
+    """
+      The lines of the resolution class a video is filed under, 1080, 720
+      or 480. Full hd is also whatever is 1920 wide, as scope movies are
+      well below 1080 high.
+    """
+    if width >= 1920 or height >= 1080:
+        return 1080
+    if width >= 1280 or height >= 720:
+        return 720
+    return 480
+
 class Movie(Base):
     __tablename__ = 'movies'
+    # the same relative path can be in several roots
+    __table_args__ = (UniqueConstraint('root_id', 'path'), )
 
     id = Column(Integer, primary_key=True)
     name = Column(String(60))
-    path = Column(String(128), unique=True)
+    path = Column(String(256))
+    # movies without a root are relative to the default one, until init
+    # records them under it
+    root_id = Column(Integer, ForeignKey('roots.id'))
 
     released = Column(DateTime)
-    year = Column(Integer)
+    year = Column(Integer, index=True)
     homepage = Column(String(128))
     imdb_id = Column(String(16))
     tagline = Column(String(256))
 
     res_x = Column(Integer)
     res_y = Column(Integer)
+    # resolutionOf(res_x, res_y), stored so listing one class is a lookup
+    resolution = Column(Integer, index=True)
 
-    runtime = Column(Integer)
+    runtime = Column(Integer, index=True)
     budget = Column(Integer)
     revenue = Column(Integer)
 
+    # when the tmdb info was fetched, and the validators tmdb sent along
+    fetched = Column(DateTime, index=True)
+    etag = Column(String(64))
+    modified = Column(String(32))
+
     actors = relationship('Actor', secondary=movie_actors, backref='movies')
     directors = relationship('Director', secondary=movie_directors, backref='movies')
     genres = relationship('Genre', secondary=movie_genres, backref='movies')
+    languages = relationship('Language', secondary=movie_languages, backref='movies')
 
-    def __init__(self, id, path, info):
+    def __init__(self, id, path, info, root_id=None):
 
         self.id = id
         self.path = path.decode('utf-8')
+        self.root_id = root_id
         self.name = info['movie']['name']
 
         self.released = datetime.strptime(info['movie']['released'], '%Y-%m-%d')
@@ -126,17 +432,24 @@ class Movie(Base):
 
         self.res_x = int(info['attrs']['ID_VIDEO_WIDTH'])
         self.res_y = int(info['attrs']['ID_VIDEO_HEIGHT'])
+        self.resolution = resolutionOf(self.res_x, self.res_y)
 
         self.runtime = int(info['movie']['runtime']) if info['movie']['runtime'] is not None else None
         self.budget = int(info['movie']['budget']) if info['movie']['budget'] is not None else None
         self.revenue = int(info['movie']['revenue']) if info['movie']['revenue'] is not None else None
 
+        self.fetched = datetime.now()
+        self.etag = info['movie'].get('etag')
+        self.modified = info['movie'].get('modified')
+
         self.actors = session.query(Actor).filter(Actor.name.in_(x['name'] for x in info['movie']['cast']['actor'])).all()
         if 'director' in info['movie']['cast']:
             self.directors = session.query(Director).filter(Director.name.in_(x['name'] for x in info['movie']['cast']['director'])).all()
         self.genres = session.query(Genre).filter(Genre.name.in_(info['movie']['categories']['genre'].keys())).all()
+        if info.get('languages'):
+            self.languages = session.query(Language).filter(Language.name.in_(info['languages'])).all()
 
-    def get_or_create(id, path, info):
+    def get_or_create(id, path, info, root_id=None):
 
         instance = session.query(Movie).filter_by(id = id).first()
         if instance:
@@ -155,7 +468,10 @@ class Movie(Base):
             for actor in info['movie']['cast']['actor']:
                 Actor.get_or_create(actor['id'], actor['name'])
 
-            movie = Movie(id, path, info)
+            for language in info.get('languages', [ ]):
+                Language.get_or_create(language)
+
+            movie = Movie(id, path, info, root_id)
             session.add(movie)
             return movie
     get_or_create = staticmethod(get_or_create)
@@ -180,20 +496,319 @@ Actors:
 
 """.format(self.name, self.year, self.tagline, ', '.join(x.name for x in self.genres), self.released.strftime('%d. %B %Y'), ', '.join(x.name for x in self.directors), self.runtime, self.homepage, self.imdb_id, self.res_x, self.res_y, '\n - '.join(x.name for x in self.actors) )
 
+    def printnfo(self):
+        """ The movie as a kodi style .nfo file, which jellyfin reads as well. """
+        lines = [ u'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>', u'<movie>' ]
+        def tag(name, value, indent=u'  '):
+            if value is not None:
+                lines.append(u'%s<%s>%s</%s>' % (indent, name, escape(unicode(value)), name))
+        tag('title', self.name)
+        tag('year', self.year)
+        tag('premiered', self.released.strftime('%Y-%m-%d') if self.released is not None else None)
+        tag('runtime', self.runtime)
+        tag('tagline', self.tagline)
+        for genre in self.genres:
+            tag('genre', genre.name)
+        for director in self.directors:
+            tag('director', director.name)
+        # the ids are tmdb's, which is what clients scrape by default
+        lines.append(u'  <uniqueid type="tmdb" default="true">%d</uniqueid>' % self.id)
+        if self.imdb_id:
+            lines.append(u'  <uniqueid type="imdb">%s</uniqueid>' % escape(self.imdb_id))
+        for actor in self.actors:
+            lines.append(u'  <actor>')
+            tag('name', actor.name, u'    ')
+            lines.append(u'  </actor>')
+        lines.append(u'  <fileinfo>')
+        lines.append(u'    <streamdetails>')
+        lines.append(u'      <video>')
+        tag('width', self.res_x, u'        ')
+        tag('height', self.res_y, u'        ')
+        lines.append(u'      </video>')
+        for language in self.languages:
+            lines.append(u'      <audio>')
+            tag('language', language.name, u'        ')
+            lines.append(u'      </audio>')
+        lines.append(u'    </streamdetails>')
+        lines.append(u'  </fileinfo>')
+        lines.append(u'</movie>')
+        return u'\n'.join(lines) + u'\n'
+
     def __repr__(self):
        return "<Movie('%s','%s')>" % (self.name, self.path)
 
+# relationships loaded along with cached movies, printinfo and printnfo need them all
+eagerly = [ subqueryload(Movie.actors), subqueryload(Movie.directors), subqueryload(Movie.genres), subqueryload(Movie.languages) ]
+
+# names in listings have os.sep replaced by '_', which LIKE takes for any character
+movie_lookup = Statement(Query([ Movie.id ]).filter(or_(Movie.name.like(bindparam('name')), Movie.imdb_id == bindparam('name'))).limit(1))
+movie_by_id = bakery(lambda s: s.query(Movie).options(*eagerly))
+movie_by_id += lambda q: q.filter(Movie.id == bindparam('id'))
+
 movie_cache = { }
+movie_cache_stats = { 'hits': 0, 'misses': 0 }
+movie_flights = SingleFlight()
 def movieFromCache(queryname):
     if queryname is None:
         return None
     if queryname in movie_cache:
+        movie_cache_stats['hits'] += 1
+        if queryname in prefetched:
+            prefetched.discard(queryname)
+            prefetch_stats['hits'] += 1
         return movie_cache[queryname]
-    movie = session.query(Movie).filter(or_(Movie.name.like(queryname), Movie.imdb_id==queryname)).first()
-    movie_cache[queryname] = movie
+    return movie_flights.do(movie_cache, queryname, lambda: loadMovie(queryname))
+
+def loadMovie(queryname):
+    movie_cache_stats['misses'] += 1
+    # finding the movie first means its relationships are loaded by id,
+    # instead of repeating the lookup once for each
+    found = movie_lookup.rows(name=queryname)
+    movie = movie_by_id(session()).params(id=found[0][0]).first() if len(found) > 0 else None
     if movie is not None:
+        # the cache is shared by all threads, so its movies must not lazy
+        # load anything through this thread's session
+        session.expunge(movie)
         movie_cache[movie.imdb_id] = movie
+    movie_cache[queryname] = movie
     return movie_cache[queryname]
 
-def init():
+movie_info = { }
+def movieInfo(movie):
+    """ Returns the info text of a movie, rendering it only once. """
+    if movie.id not in movie_info:
+        movie_info[movie.id] = movie.printinfo()
+    return movie_info[movie.id]
+
+movie_nfo = { }
+def movieNfo(movie):
+    """ Returns the .nfo of a movie, utf-8 encoded, rendering it only once. """
+    if movie.id not in movie_nfo:
+        movie_nfo[movie.id] = movie.printnfo().encode('utf-8')
+    return movie_nfo[movie.id]
+
+root_path = Statement(Query([ Root.path ]).filter(Root.id == bindparam('id')))
+root_paths = { }
+def moviePath(movie, default):
+    """ Path of a movie's file, below its root, or default for movies without one. """
+    if movie.root_id is None:
+        return os.path.join(default, movie.path)
+    if movie.root_id not in root_paths:
+        found = root_path.rows(id=movie.root_id)
+        root_paths[movie.root_id] = found[0][0] if len(found) > 0 else None
+    return os.path.join(root_paths[movie.root_id], movie.path)
+
+data_version = Statement(text('PRAGMA data_version'))
+def dataVersion():
+    """ A number that changes whenever another connection commits to the database. """
+    return data_version.rows()[0][0]
+
+# the movie fields of catalogue records, then the lists of names of each
+catalog_fields = [ 'id', 'name', 'year', 'released', 'runtime', 'imdb_id', 'res_x', 'res_y', 'homepage', 'tagline', 'budget', 'revenue' ]
+catalog_movies = Statement(Query(list(getattr(Movie, x) for x in catalog_fields))
+        .filter(Movie.id > bindparam('after')).order_by(Movie.id).limit(bindparam('limit')))
+catalog_lists = [ ]
+for name, table, model in [ ('genres', movie_genres, Genre), ('directors', movie_directors, Director),
+                            ('actors', movie_actors, Actor), ('languages', movie_languages, Language) ]:
+    catalog_lists.append((name, Statement(Query([ table.c.movie_id, model.name ]).select_from(table)
+        .join(model, model.id == table.c.values()[0])
+        .filter(table.c.movie_id > bindparam('after')).filter(table.c.movie_id <= bindparam('last')))))
+catalog_columns = catalog_fields + [ 'dir' ] + list(x[0] for x in catalog_lists)
+
+movie_count = Statement(Query([ func.count(Movie.id) ]))
+def movieCount():
+    return movie_count.rows()[0][0]
+
+def catalogRecords(after, limit):
+    """
+      Returns catalogue records of up to limit movies with ids above after,
+      by id, as dicts with the keys in catalog_columns. A handful of
+      queries, whatever the limit.
+    """
+    records = [ ]
+    byid = { }
+    for row in catalog_movies.rows(after=after, limit=limit):
+        record = dict(zip(catalog_fields, row))
+        if record['released'] is not None:
+            record['released'] = record['released'][:10]
+        record['dir'] = '/title/' + record['name'].replace(os.sep, '_') if record['name'] is not None else None
+        records.append(record)
+        byid[record['id']] = record
+    if len(records) == 0:
+        return records
+    for name, statement in catalog_lists:
+        for record in records:
+            record[name] = [ ]
+        for movie_id, value in statement.rows(after=after, last=records[-1]['id']):
+            byid[movie_id][name].append(value)
+    return records
+
+def invalidate():
+    """ Forgets all cached movies, after the database changed. """
+    movie_cache.clear()
+    movie_info.clear()
+    movie_nfo.clear()
+    artwork_cache.clear()
+    root_paths.clear()
+    prefetched.clear()
+
+movie_artwork = Statement(Query([ Artwork.kind, Artwork.digest ]).filter(Artwork.movie_id == bindparam('id')))
+artwork_cache = { }
+def artworkFromCache(movie):
+    """ Returns a dict of artwork kind to digest for a movie. """
+    if movie.id not in artwork_cache:
+        artwork_cache[movie.id] = dict(movie_artwork.rows(id=movie.id))
+    return artwork_cache[movie.id]
+
+# names put into movie_cache by the Prefetcher, which have not been asked for yet
+prefetched = set()
+prefetch_stats = { 'queued': 0, 'dropped': 0, 'batches': 0, 'prefetched': 0, 'hits': 0 }
+
+class Prefetcher(threading.Thread):
+    """
+      Background loader for the movie cache. After a directory of movies is
+      listed, its (name, id) pairs are handed in here and loaded by id in
+      batches, together with their rendered info, so the getattr/read
+      burst that typically follows a listing is served from memory. The
+      names are those of the listing, with os.sep replaced, and that is
+      what the movies are cached under.
+
+      At most depth listings are pending at any time, anything beyond that is
+      dropped rather than queued.
+    """
+
+    # stay well below sqlite's limit of bound variables per statement
+    batchsize = 500
+
+    def __init__(self, depth):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = Queue.Queue(depth)
+
+    def enqueue(self, entries):
+        entries = list(x for x in entries if x[0] not in movie_cache)
+        if len(entries) == 0:
+            return
+        try:
+            self.queue.put_nowait(entries)
+            prefetch_stats['queued'] += 1
+        except Queue.Full:
+            prefetch_stats['dropped'] += 1
+
+    def run(self):
+        while True:
+            entries = self.queue.get()
+            for i in range(0, len(entries), self.batchsize):
+                self.load(entries[i:i+self.batchsize])
+
+    def load(self, entries):
+        names = dict((ident, name) for name, ident in entries)
+        # the mount's session belongs to the fuse thread, we need our own
+        loader = newSession()
+        try:
+            movies = loader.query(Movie).options(*eagerly).filter(Movie.id.in_(names.keys())).all()
+            for movie in movies:
+                movie_info[movie.id] = movie.printinfo()
+                movie_nfo[movie.id] = movie.printnfo().encode('utf-8')
+        finally:
+            # everything we need is loaded, the objects can live on detached
+            loader.close()
+        for movie in movies:
+            name = names[movie.id]
+            if name in movie_cache:
+                continue
+            movie_cache[name] = movie
+            movie_cache[movie.imdb_id] = movie
+            prefetched.add(name)
+            prefetch_stats['prefetched'] += 1
+        prefetch_stats['batches'] += 1
+
+def init(root=None):
+    """
+      Creates the database, or brings an existing one up to date. Movies
+      recorded without a root are recorded under root, if given.
+    """
+    engine = getEngine()
     Base.metadata.create_all(engine)
+    # create_all leaves existing tables alone, add columns and indexes they lack
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(x['name'] for x in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name, column.type.compile(engine.dialect)))
+    if any(x['column_names'] == [ 'path' ] for x in inspector.get_unique_constraints('movies')):
+        rebuildMovies(engine)
+    # the inspector caches what it found, and the rebuild dropped indexes
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(x['name'] for x in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+    if root is not None:
+        adoptRootless(root)
+    backfillLanguages()
+    backfillResolutions()
+
+def rebuildMovies(engine):
+    """
+      Moves the movies into a table of the current schema, for databases
+      where paths had to be unique across all roots. sqlite can't drop a
+      constraint, the table has to be made anew, in one transaction.
+    """
+    columns = ', '.join(Movie.__table__.columns.keys())
+    create = unicode(CreateTable(Movie.__table__).compile(dialect=engine.dialect))
+    fairy = engine.raw_connection()
+    conn = fairy.connection
+    # the sqlite module commits on its own before schema changes
+    isolation = conn.isolation_level
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN')
+        cursor.execute(create.replace('CREATE TABLE movies ', 'CREATE TABLE movies_new ', 1))
+        cursor.execute('INSERT INTO movies_new (%s) SELECT %s FROM movies' % (columns, columns))
+        cursor.execute('DROP TABLE movies')
+        cursor.execute('ALTER TABLE movies_new RENAME TO movies')
+        cursor.execute('COMMIT')
+    except Exception:
+        cursor.execute('ROLLBACK')
+        raise
+    finally:
+        cursor.close()
+        conn.isolation_level = isolation
+        fairy.close()
+
+def adoptRootless(path):
+    """ Records the movies without a root, which are below path, under a Root of it. """
+    if session.query(Movie.id).filter(Movie.root_id == None).first() is None:
+        return
+    root = Root.get_or_create(path)
+    session.flush()
+    session.query(Movie).filter(Movie.root_id == None).update({ Movie.root_id: root.id }, synchronize_session=False)
+    session.commit()
+
+def backfillLanguages():
+    """
+      Gives movies ingested before languages were stored the ones listed
+      in their directory name, like 'Name [eng,ger]'.
+    """
+    known = set(x[0] for x in session.query(movie_languages.c.movie_id).distinct())
+    for movie in session.query(Movie):
+        if movie.id in known:
+            continue
+        match = re.search(r'\[([a-z,]+)\]$', os.path.dirname(movie.path))
+        if match is None:
+            continue
+        movie.languages = list(Language.get_or_create(x) for x in sorted(set(match.group(1).split(','))))
+    session.commit()
+
+def backfillResolutions():
+    """ Files movies stored before the resolution column into their class. """
+    movies = session.query(Movie.id, Movie.res_x, Movie.res_y).filter(Movie.resolution == None, Movie.res_x != None).all()
+    if len(movies) == 0:
+        return
+    update = Movie.__table__.update().where(Movie.id == bindparam('ident')).values(resolution=bindparam('lines'))
+    session.execute(update, list({ 'ident': x[0], 'lines': resolutionOf(x[1], x[2]) } for x in movies))
+    session.commit()
@@ -0,0 +1,107 @@
+import db
+import tmdb
+
+import os
+from multiprocessing.pool import ThreadPool
+
+# files considered part of the library when walking directories
+extensions = [ '.mkv', '.avi', '.mp4', '.m4v', '.mov', '.wmv', '.mpg', '.mpeg', '.ts', '.iso' ]
+
+# read size for full content comparisons
+chunksize = 1 << 20
+
+def libraryfiles(dirs):
+    """ Yields all video files below a list of directories. """
+    for top in dirs:
+        for dirpath, dirnames, filenames in os.walk(top):
+            for fname in filenames:
+                if os.path.splitext(fname)[1].lower() in extensions:
+                    yield os.path.join(dirpath, fname)
+
+def hashfile(path):
+    try:
+        return path, tmdb.opensubtitleHashFile(path)
+    except ValueError:
+        # too small to be hashed, these are told apart by size and contents only
+        return path, None
+
+def samecontent(a, b):
+    with open(a, 'rb') as fa:
+        with open(b, 'rb') as fb:
+            while True:
+                ca = fa.read(chunksize)
+                if ca != fb.read(chunksize):
+                    return False
+                if not ca:
+                    return True
+
+def confirm(paths):
+    """ Splits a list of candidate files into groups of identical contents, leaving out unique ones. """
+    groups = [ ]
+    for path in paths:
+        for group in groups:
+            if samecontent(group[0], path):
+                group.append(path)
+                break
+        else:
+            groups.append([ path ])
+    return list(x for x in groups if len(x) > 1)
+
+def find(paths, jobs=8):
+    """
+      Finds files with identical contents among paths. Returns a list of
+      (size, [ path, ... ]) for each group of duplicates.
+
+      Files are first grouped by size and opensubtitles hash, which only
+      reads 128k of each file. Hashes are cached in the database along with
+      size and mtime, so unchanged files are not even opened again. Only
+      files that collide on both are compared in full. Hashing and the
+      comparisons run in jobs threads.
+    """
+    files = { }
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        files[path] = (st.st_size, int(st.st_mtime))
+
+    hashes = { }
+    todo = [ ]
+    cached = dict((x.path, x) for x in db.session.query(db.FileHash))
+    for path, (size, mtime) in files.iteritems():
+        fh = cached.get(path.decode('utf-8'))
+        if fh is not None and fh.size == size and fh.mtime == mtime:
+            hashes[path] = fh.hash
+        else:
+            todo.append(path)
+
+    # files of a size nothing else has can't have a duplicate, don't bother hashing them
+    sizes = { }
+    for size, mtime in files.itervalues():
+        sizes[size] = sizes.get(size, 0) + 1
+    todo = list(x for x in todo if sizes[files[x][0]] > 1)
+
+    pool = ThreadPool(jobs)
+    try:
+        for path, fhash in pool.imap_unordered(hashfile, todo):
+            hashes[path] = fhash
+            db.FileHash.set(path.decode('utf-8'), files[path][0], files[path][1], fhash)
+        db.session.commit()
+
+        candidates = { }
+        for path, fhash in hashes.iteritems():
+            if sizes[files[path][0]] > 1:
+                candidates.setdefault((files[path][0], fhash), [ ]).append(path)
+        candidates = list((size, sorted(x)) for (size, fhash), x in candidates.iteritems() if len(x) > 1)
+
+        confirmed = pool.map(confirm, list(x for _, x in candidates))
+    finally:
+        pool.close()
+
+    dupes = [ ]
+    for (size, _), groups in zip(candidates, confirmed):
+        for group in groups:
+            dupes.append((size, group))
+    dupes.sort(reverse=True)
+    return dupes
@@ -1,12 +1,127 @@
 from fuse import FUSE, LoggingMixIn, Operations
 import db
+from db import Prefetcher, Root, root_paths
+from stats import Stats, Profiler
+from traces import TraceWriter
+import artwork
 
-import itertools
 from stat import S_IFREG, S_IFDIR, S_IFLNK
-from time import time
+from time import time, sleep, mktime
 from errno import *
 import os
+import csv
+import json
+import bisect
 import signal
+import threading
+from StringIO import StringIO
+
+# inode numbers are (kind << 48) | id, with the id taken from the database,
+# so they stay the same across remounts. kind 0 holds the fixed entries of
+# the mount root, every sub-filesystem has its own kind for its criteria.
+INO_FIXED = 0
+INO_MOVIE = 1
+INO_INFO = 2
+INO_VIDEO = 3
+INO_ARTWORK = 4   # one kind per artwork file, in order of their names
+INO_NFO = 15
+
+def inode(kind, ident):
+    return (kind << 48) | (ident & 0xffffffffffff)
+
+class EncodedNames(list):
+    """ A directory listing whose names are utf-8 encoded already. """
+    pass
+
+class Listing(object):
+    """
+      A cached directory listing, made from (name, id) pairs. Besides the
+      names it keeps a set of them for lookups, their utf-8 encoding, and the
+      database id behind each name, so none of that is redone on each call.
+    """
+    __slots__ = ('names', 'nameset', 'encoded', 'ids')
+
+    def __init__(self, entries):
+        self.names = list(x[0] for x in entries)
+        self.nameset = frozenset(self.names)
+        self.encoded = EncodedNames(x.encode('utf-8') for x in self.names)
+        self.ids = dict(entries)
+
+class PassthroughFile(object):
+    """
+      An open video file in passthrough mode. Sequential reads are served from
+      a read-ahead buffer, so the typical stream of small fuse reads costs one
+      syscall per buffer instead of one per request.
+    """
+
+    readahead = 1 << 20
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.buf = ''
+        self.bufoffset = 0
+
+    def read(self, size, offset):
+        start = offset - self.bufoffset
+        if start >= 0 and offset + size <= self.bufoffset + len(self.buf):
+            return self.buf[start:start+size]
+        # the mount is single threaded, so seek + read on our own fd is safe
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        self.buf = os.read(self.fd, max(size, self.readahead))
+        self.bufoffset = offset
+        return self.buf[:size]
+
+    def close(self):
+        os.close(self.fd)
+
+class RootMonitor(object):
+    """
+      Tells which library roots can be reached. Each root is checked every
+      interval seconds by a thread of its own, so a root that hangs, like
+      one on a dead nfs server, only ever blocks that thread. A root is
+      offline while its last check failed, or while a check has not come
+      back for timeout seconds.
+    """
+
+    interval = 10
+    timeout = 2
+
+    def __init__(self, paths):
+        # root -> [ start of the running check or None, whether the last one succeeded ]
+        self.roots = { }
+        for path in paths:
+            if isinstance(path, str):
+                path = path.decode('utf-8')
+            self.roots[os.path.abspath(path)] = [ time(), True ]
+        # roots can be nested, the longest one a path is below is its root
+        self.longest = sorted(self.roots, key=len, reverse=True)
+        for path in self.roots:
+            thread = threading.Thread(target=self.run, args=(path, ))
+            thread.daemon = True
+            thread.start()
+
+    def run(self, path):
+        state = self.roots[path]
+        while True:
+            state[0] = time()
+            state[1] = os.path.isdir(path)
+            state[0] = None
+            sleep(self.interval)
+
+    def online(self, path):
+        """ Whether the root path lies below can be reached. """
+        for root in self.longest:
+            if path == root or path.startswith(root + os.sep):
+                started, ok = self.roots[root]
+                return ok and (started is None or time() - started < self.timeout)
+        return True
+
+    def wait(self):
+        """ Waits for the first check of all roots, at most timeout seconds. Returns the offline ones. """
+        deadline = time() + self.timeout
+        while time() < deadline and any(x[0] is not None for x in self.roots.itervalues()):
+            sleep(0.01)
+        return sorted(x for x in self.roots if not self.online(x))
 
 class BaseMovieFS(Operations):
     """
@@ -20,6 +135,15 @@ class BaseMovieFS(Operations):
     def __init__(self, pathbase, db):
         self.pathbase = pathbase
         self.db = db
+        # set by MovieFS if movies should be loaded ahead of time
+        self.prefetcher = None
+        # set by MovieFS if videos should be regular files instead of symlinks
+        self.passthrough = False
+        # set by MovieFS to the artwork store, if artwork should be shown
+        self.artworkstore = None
+        # set by MovieFS to a RootMonitor, if roots are watched
+        self.monitor = None
+        self.handles = { }
 
     def readdir(self, pieces, fh):
         # shouldn't happen - this is typically the case handled by inheriting classes
@@ -30,7 +154,7 @@ class BaseMovieFS(Operations):
             movie = db.movieFromCache(pieces[-1])
             if not movie or movie is None:
                 raise OSError(ENOENT, '')
-            return ['.', '..', os.path.basename(movie.path).replace(os.sep, ' '), 'info' ]
+            return ['.', '..', os.path.basename(movie.path).replace(os.sep, ' '), 'info', self.nfoname(movie) ] + list(x for x in artwork.filenames if self.artworkpath(movie, x) is not None)
 
     def readlink(self, pieces):
         # need at least two levels for this to make sense: -2 is the movie dir, -1 is the filename
@@ -41,7 +165,28 @@ class BaseMovieFS(Operations):
             # we have an actual movie selected here - just return its personal directory
             if not movie or movie is None:
                 raise OSError(ENOENT, '')
-            return os.path.abspath( self.pathbase + '/' + movie.path )
+            return self.moviepath(movie)
+
+    def moviepath(self, movie):
+        return os.path.abspath(db.moviePath(movie, self.pathbase))
+
+    def nfoname(self, movie):
+        """ The .nfo is named like the video, which is where media centers look for it. """
+        return os.path.splitext(os.path.basename(movie.path).replace(os.sep, ' '))[0] + '.nfo'
+
+    def reachable(self, path):
+        """ Raises EIO for files on an offline root, rather than blocking on them. """
+        if self.monitor is not None and not self.monitor.online(path):
+            raise OSError(EIO, '')
+
+    def artworkpath(self, movie, name):
+        """ Path of an artwork file of a movie in the store, or None if there is none. """
+        if self.artworkstore is None or name not in artwork.filenames:
+            return None
+        digest = db.artworkFromCache(movie).get(artwork.filenames[name])
+        if digest is None:
+            return None
+        return artwork.storepath(self.artworkstore, digest)
 
     def getattr(self, pieces, fh=None):
         if len(pieces) <= 1:
@@ -59,15 +204,57 @@ class BaseMovieFS(Operations):
             if pieces[-1] == 'info':
                 # otherwise, it's a symbolic link
                 st = {
+                    'st_ino': inode(INO_INFO, movie.id),
                     'st_mode': S_IFREG | 0644,
-                    'st_size': len(movie.printinfo()),
+                    'st_size': len(db.movieInfo(movie)),
                     'st_nlink': 1,
                 }
                 st['st_ctime'] = st['st_mtime'] = st['st_atime'] = time()
                 return st
+            elif pieces[-1] == self.nfoname(movie):
+                st = {
+                    'st_ino': inode(INO_NFO, movie.id),
+                    'st_mode': S_IFREG | 0444,
+                    'st_size': len(db.movieNfo(movie)),
+                    'st_nlink': 1,
+                }
+                # media centers scan again what changed, which is when its info was fetched
+                st['st_ctime'] = st['st_mtime'] = st['st_atime'] = mktime(movie.fetched.timetuple()) if movie.fetched is not None else time()
+                return st
+            elif self.artworkpath(movie, pieces[-1]) is not None:
+                try:
+                    real = os.stat(self.artworkpath(movie, pieces[-1]))
+                except OSError:
+                    raise OSError(ENOENT, '')
+                return {
+                    'st_ino': inode(INO_ARTWORK + sorted(artwork.filenames).index(pieces[-1]), movie.id),
+                    'st_mode': S_IFREG | 0444,
+                    'st_size': real.st_size,
+                    'st_nlink': 1,
+                    'st_ctime': real.st_ctime,
+                    'st_mtime': real.st_mtime,
+                    'st_atime': real.st_atime,
+                }
             elif pieces[-1] == os.path.basename(movie.path).replace(os.sep, ' '):
+                if self.passthrough:
+                    # a regular file, which looks just like the original
+                    self.reachable(self.moviepath(movie))
+                    try:
+                        real = os.stat(self.moviepath(movie))
+                    except OSError:
+                        raise OSError(ENOENT, '')
+                    return {
+                        'st_ino': inode(INO_VIDEO, movie.id),
+                        'st_mode': S_IFREG | 0444,
+                        'st_size': real.st_size,
+                        'st_nlink': 1,
+                        'st_ctime': real.st_ctime,
+                        'st_mtime': real.st_mtime,
+                        'st_atime': real.st_atime,
+                    }
                 # otherwise, it's a symbolic link
                 st = {
+                    'st_ino': inode(INO_VIDEO, movie.id),
                     'st_mode': S_IFLNK | 0777,
                     'st_nlink': 1,
                 }
@@ -77,11 +264,42 @@ class BaseMovieFS(Operations):
                 raise OSError(ENOENT, '')
 
 
+    def open(self, pieces, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise OSError(EROFS, '')
+        if len(pieces) <= 1 or pieces[-1] == 'info':
+            return 0
+        movie = db.movieFromCache(pieces[-2])
+        if movie is None:
+            raise OSError(ENOENT, '')
+        if self.artworkpath(movie, pieces[-1]) is not None:
+            f = PassthroughFile(self.artworkpath(movie, pieces[-1]))
+        elif self.passthrough and pieces[-1] == os.path.basename(movie.path).replace(os.sep, ' '):
+            self.reachable(self.moviepath(movie))
+            f = PassthroughFile(self.moviepath(movie))
+        else:
+            return 0
+        self.handles[f.fd] = f
+        return f.fd
+
+    def release(self, pieces, fh):
+        if fh in self.handles:
+            self.handles.pop(fh).close()
+        return 0
+
     def read(self, pieces, size, offset, fh=None):
-        if len(pieces) <= 1 or pieces[-1] != 'info':
+        if fh in self.handles:
+            return self.handles[fh].read(size, offset)
+        if len(pieces) <= 1:
             raise OSError(ENOENT, '')
         movie = db.movieFromCache(pieces[-2])
-        return movie.printinfo()
+        if movie is None:
+            raise OSError(ENOENT, '')
+        if pieces[-1] == 'info':
+            return db.movieInfo(movie)
+        if pieces[-1] == self.nfoname(movie):
+            return db.movieNfo(movie)[offset:offset+size]
+        raise OSError(ENOENT, '')
 
 class MultiLevelFS(BaseMovieFS):
     """
@@ -91,32 +309,48 @@ class MultiLevelFS(BaseMovieFS):
       Stuff handled here in caps: /fstype/CRITERIA/moviedir/movieinfo
 
       The only thing that differs in subclasses is the list of criteria and
-      assorted movies.
+      assorted movies. Each level returns (name, id) pairs, where the id is
+      that of the criteria, or of the movie on the last level. Subclasses
+      also have their own inode kind for their criteria, which is at the
+      same time the inode number of their top directory.
     """
 
     def __init__(self, *args):
         BaseMovieFS.__init__(self, *args)
         self.levelCache = { }
+        self.cacheStats = { 'hits': 0, 'misses': 0 }
+        self.flights = db.SingleFlight()
 
     def readdir(self, pieces, fh):
         # we NEED the list of criteria!
         if len(self.levels) == 0:
             raise OSError(ENOTSUP, '')
         if len(pieces) < len(self.levels):
-            return self.cachedir(pieces)
+            listing = self.cachedir(pieces)
+            # the next level down are movies, which are about to be stat'ed
+            if self.prefetcher is not None and 0 < len(pieces) == len(self.levels) - 1:
+                self.prefetcher.enqueue(listing.ids.items())
+            return listing.encoded
         else:
             return super(MultiLevelFS, self).readdir(pieces, fh)
 
     def cachedir(self, pieces):
-        joined = '/'.join(pieces)
-        if joined not in self.levelCache:
-            self.levelCache[joined] = self.levels[len(pieces)](self, pieces)
-        return self.levelCache[joined]
+        """ Returns the Listing of a level directory, pieces is a tuple. """
+        if pieces in self.levelCache:
+            self.cacheStats['hits'] += 1
+            return self.levelCache[pieces]
+        return self.flights.do(self.levelCache, pieces, lambda: self.loaddir(pieces))
+
+    def loaddir(self, pieces):
+        self.cacheStats['misses'] += 1
+        listing = self.levelCache[pieces] = Listing(self.levels[len(pieces)](self, pieces))
+        return listing
 
     def getattr(self, pieces, fh=None):
         if len(pieces) == 0:
             # top dir: it's a directory
             st = {
+                'st_ino': inode(INO_FIXED, self.inokind),
                 'st_mode': S_IFDIR | 0755,
                 'st_nlink': 2,
             }
@@ -126,9 +360,11 @@ class MultiLevelFS(BaseMovieFS):
             # for all subdirectories..
             for i in range(0, len(pieces)):
                 # see if this entry exists in the dir cache
-                if pieces[i] not in self.cachedir(pieces[0:i]):
+                listing = self.cachedir(pieces[0:i])
+                if pieces[i] not in listing.nameset:
                     raise OSError(ENOENT, '')
             st = {
+                'st_ino': inode(INO_MOVIE if len(pieces) == len(self.levels) else self.inokind, listing.ids[pieces[-1]]),
                 'st_mode': S_IFDIR | 0755,
                 'st_nlink': 2,
             }
@@ -137,94 +373,305 @@ class MultiLevelFS(BaseMovieFS):
         else:
             return super(MultiLevelFS, self).getattr(pieces, fh)
 
-class TitleFS(MultiLevelFS):
-    """ Trivial filesystem, just list by title and let BaseMovieFS handle all the rest. """
-    def level_one(self, pieces):
-        return list(x[0].replace(os.sep, '_') for x in itertools.chain(self.db.query(db.Movie.name)))
-
-    levels = [ level_one ]
-
-class ImdbFS(MultiLevelFS):
-    """ Trivial filesystem, just list by title and let BaseMovieFS handle all the rest. """
-    def level_one(self, pieces):
-        return list(x[0].replace(os.sep, '_') for x in itertools.chain(self.db.query(db.Movie.imdb_id)))
-
-    levels = [ level_one ]
-
-class RuntimeFS(MultiLevelFS):
-    """ Simple two-level filesystem, shows a list of actors. """
-    def level_one(self, pieces):
-        return list(str(x[0]*10) for x in filter(lambda x: x[0] is not None, self.db.query(db.Movie.runtime.op("/")(10)).distinct()))
-    def level_two(self, pieces):
-        # the first level should be an actor
-        return list(x[0].replace(os.sep, '_') for x in itertools.chain(self.db.query(db.Movie.name).filter(db.Movie.runtime.op("/")(10)==int(pieces[0])/10)))
-        # it's not?!
-        if not movies:
-            raise OSError(ENOENT, '')
-        # it is. show a list of all his movies
-        return list(x.name.replace(os.sep, '_') for x in movie)
-
-    levels = [ level_one, level_two ]
-
-class GenreFS(MultiLevelFS):
-    """ Simple two-level filesystem, shows a list of actors. """
-    def level_one(self, pieces):
-        return list(x[0].replace(os.sep, '_') for x in self.db.query(db.Genre.name))
-    def level_two(self, pieces):
-        # the first level should be an actor
-        genre = self.db.query(db.Genre).filter_by(name=pieces[0]).first()
-        # it's not?!
-        if not genre:
-            raise OSError(ENOENT, '')
-        # it is. show a list of all his movies
-        return list(x.name.replace(os.sep, '_') for x in genre.movies)
-
-    levels = [ level_one, level_two ]
-
-class DirectorFS(MultiLevelFS):
-    """ Simple two-level filesystem, shows a list of actors. """
-    def level_one(self, pieces):
-        return list(x[0].replace(os.sep, '_') for x in self.db.query(db.Director.name).all())
-    def level_two(self, pieces):
-        # the first level should be an actor
-        director = self.db.query(db.Director).filter_by(name=pieces[0]).first()
-        # it's not?!
-        if not director:
-            raise OSError(ENOENT, '')
-        # it is. show a list of all his movies
-        return list(x.name.replace(os.sep, '_') for x in director.movies)
-
-    levels = [ level_one, level_two ]
-
-class ActorFS(MultiLevelFS):
-    """ Simple two-level filesystem, shows a list of actors. """
-    def level_one(self, pieces):
-        return list(x[0].replace(os.sep, '_') for x in self.db.query(db.Actor.name).join(db.movie_actors).group_by(db.Actor.id).having(db.func.count(db.Actor.id)>=3))
-    def level_two(self, pieces):
-        # the first level should be an actor
-        actor = self.db.query(db.Actor).filter_by(name=pieces[0]).first()
-        # it's not?!
-        if not actor:
-            raise OSError(ENOENT, '')
-        # it is. show a list of all his movies
-        return list(x.name.replace(os.sep, '_') for x in actor.movies)
+class Facet(object):
+    """
+      Declares a way of grouping movies. key is the sql expression of the
+      criteria a movie is filed under, joins are what has to be joined to
+      the movies to get at it. Each distinct key is a directory, named by
+      label (the key itself by default) and format, and lists the movies
+      with that key by title. Keys of the same name share a directory.
+      Only keys with at least minimum movies are shown.
+
+      lookup makes the condition for the movies of a key, given as a bind
+      parameter, where comparing with key would not use an index.
+
+      Without a key, movies are listed right away, named by movies.
+    """
 
-    levels = [ level_one, level_two ]
+    def __init__(self, inokind, key=None, label=None, joins=[ ], minimum=1, format=unicode, movies=db.Movie.name, lookup=None):
+        self.inokind = inokind
+        self.key = key
+        self.label = label if label is not None else key
+        self.joins = joins
+        self.minimum = minimum
+        self.format = format
+        self.movies = movies
+        self.lookup = lookup
+
+def ranges(inokind, column, width, format=unicode):
+    """ A Facet filing movies into ranges of column, width wide. """
+    return Facet(inokind, key=column.op('/')(width) * width, format=format,
+                 lookup=lambda key: db.and_(column >= key, column < key + width))
+
+resolutionnames = { 480: u'SD', 720: u'720p', 1080: u'1080p' }
+
+# everything that is listed in the mount root, adding a view is adding a line
+facets = {
+    'title':      Facet(16),
+    'imdb':       Facet(17, movies=db.Movie.imdb_id),
+    'runtime':    ranges(18, db.Movie.runtime, 10),
+    'genre':      Facet(19, key=db.movie_genres.c.genre_id, label=db.Genre.name, joins=[ db.movie_genres, db.Genre ]),
+    'director':   Facet(20, key=db.movie_directors.c.director_id, label=db.Director.name, joins=[ db.movie_directors, db.Director ]),
+    'actor':      Facet(21, key=db.movie_actors.c.actor_id, label=db.Actor.name, joins=[ db.movie_actors, db.Actor ], minimum=3),
+    'year':       Facet(22, key=db.Movie.year),
+    'resolution': Facet(23, key=db.Movie.resolution, format=resolutionnames.get),
+    'decade':     ranges(24, db.Movie.year, 10, format=lambda x: u'%ds' % x),
+    'language':   Facet(25, key=db.movie_languages.c.language_id, label=db.Language.name, joins=[ db.movie_languages, db.Language ]),
+}
+
+class FacetFS(MultiLevelFS):
+    """
+      Lists movies as declared by a Facet. Each level is a single query,
+      the criteria are grouped by their key in sql, and the movies of one
+      are looked up by its key, which the level above has in its Listing.
+      Both queries are db.Statements, built here and compiled only once.
+    """
 
-class YearFS(MultiLevelFS):
-    """ Simple two-level filesystem, shows a list of actors. """
-    def level_one(self, pieces):
-        years = list(str(x[0]) for x in self.db.query(db.Movie.year).distinct())
-        if len(years) == 0:
+    def __init__(self, facet, *args):
+        MultiLevelFS.__init__(self, *args)
+        self.facet = facet
+        self.inokind = facet.inokind
+        movies = db.Query([ facet.movies, db.Movie.id ]).select_from(db.Movie)
+        if facet.key is None:
+            self.levels = [ FacetFS.level_movies ]
+            self.movies = db.Statement(movies)
+            return
+        self.levels = [ FacetFS.level_criteria, FacetFS.level_movies ]
+        # key -> the other keys listed under its name
+        self.aliases = { }
+        criteria = db.Query([ facet.key, facet.label.label('label') ]).select_from(db.Movie)
+        for join in facet.joins:
+            criteria = criteria.join(join)
+            movies = movies.join(join)
+        criteria = criteria.filter(facet.key != None).group_by(facet.key)
+        if facet.minimum > 1:
+            criteria = criteria.having(db.func.count(db.Movie.id) >= facet.minimum)
+        self.criteria = db.Statement(criteria)
+        if facet.lookup is not None:
+            condition = facet.lookup(db.bindparam('key'))
+        else:
+            condition = facet.key == db.bindparam('key')
+        self.movies = db.Statement(movies.filter(condition))
+
+    def level_criteria(self, pieces):
+        # labels need not be unique, like two genres of the same name, the
+        # first key of a name stands for all of them
+        entries = [ ]
+        first = { }
+        aliases = { }
+        for key, label in self.criteria.rows():
+            name = self.facet.format(label).replace(os.sep, '_')
+            if name in first:
+                aliases.setdefault(first[name], [ ]).append(key)
+                continue
+            first[name] = key
+            entries.append((name, key))
+        self.aliases = aliases
+        return entries
+
+    def level_movies(self, pieces):
+        if len(pieces) == 0:
+            rows = self.movies.rows()
+        else:
+            listing = self.cachedir(pieces[:-1])
+            if pieces[-1] not in listing.nameset:
+                raise OSError(ENOENT, '')
+            key = listing.ids[pieces[-1]]
+            rows = self.movies.rows(key=key)
+            if key in self.aliases:
+                for alias in self.aliases[key]:
+                    rows.extend(self.movies.rows(key=alias))
+                rows = dict((x[1], x) for x in rows).values()
+        return list((x[0].replace(os.sep, '_'), x[1]) for x in rows if x[0] is not None)
+
+class GeneratedFile(Operations):
+    """
+      A read-only file in the mount root whose contents are generated by a
+      function. Every open takes a fresh snapshot, unless getattr took one
+      just before, so the size it reported matches what is read.
+    """
+    def __init__(self, generate, ino):
+        self.generate = generate
+        self.ino = ino
+        self.snapshot = None
+        self.snapshotTime = 0
+        self.handles = { }
+        self.nexthandle = 1
+
+    def take(self):
+        self.snapshot = self.generate().encode('utf-8')
+        self.snapshotTime = time()
+        return self.snapshot
+
+    def getattr(self, pieces, fh=None):
+        if len(pieces) > 0:
             raise OSError(ENOENT, '')
-        return years
-    def level_two(self, pieces):
-        movies = list(x[0].replace(os.sep, '_') for x in self.db.query(db.Movie.name).filter_by(year=pieces[0]))
-        if len(movies) == 0:
+        st = {
+            'st_ino': inode(INO_FIXED, self.ino),
+            'st_mode': S_IFREG | 0444,
+            'st_size': len(self.take()),
+            'st_nlink': 1,
+        }
+        st['st_ctime'] = st['st_mtime'] = st['st_atime'] = time()
+        return st
+
+    def open(self, pieces, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise OSError(EROFS, '')
+        fh = self.nexthandle
+        self.nexthandle += 1
+        self.handles[fh] = self.snapshot if time() - self.snapshotTime < 1 else self.take()
+        return fh
+
+    def release(self, pieces, fh):
+        self.handles.pop(fh, None)
+        return 0
+
+    def read(self, pieces, size, offset, fh=None):
+        data = self.handles[fh] if fh in self.handles else self.take()
+        return data[offset:offset+size]
+
+def catalogJson(records, first):
+    return ''.join(json.dumps(x) + '\n' for x in records)
+
+def csvValue(value):
+    if isinstance(value, list):
+        value = u'|'.join(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value
+
+def catalogCsv(records, first):
+    """ Lists are joined with '|', the first chunk starts with a header line. """
+    out = StringIO()
+    writer = csv.writer(out)
+    if first:
+        writer.writerow(db.catalog_columns)
+    for record in records:
+        writer.writerow(list(csvValue(record[x]) for x in db.catalog_columns))
+    return out.getvalue()
+
+class CatalogFile(Operations):
+    """
+      A read-only file in the mount root with a record of every movie, so a
+      client gets the whole catalogue in one sequential read rather than by
+      walking /title. render turns a list of db.catalogRecords into bytes.
+
+      The file is made of chunks of chunksize movies, by id. Of each chunk
+      only its offset and the id before it are kept, a read generates the
+      chunks it covers, and the last one generated is kept for the reads
+      that follow. Laying the chunks out takes one pass over all movies,
+      which open and read repeat after the database changed.
+
+      Until then getattr, which the mount's single thread answers for
+      every ls of the root, reports an estimate instead. It is meant to be
+      too big rather than too small: the kernel takes a short read as the
+      end of the file, but does not read past the size it was told.
+    """
+
+    chunksize = 500
+    # how much bigger than the last bytes per movie times the movies the
+    # estimate is
+    headroom = 1.25
+
+    def __init__(self, render, ino):
+        self.render = render
+        self.ino = ino
+        self.lock = threading.Lock()
+        # bytes per movie of the last layout, the estimate is based on it
+        self.permovie = None
+        self.invalidate()
+
+    def invalidate(self):
+        # (offset of each chunk, id of the movie before each, size, when
+        # it was built), replaced as a whole so readers never see half
+        self.layout = None
+        # (layout, chunk number, data) of the last chunk generated
+        self.last = (None, None, None)
+        self.changed = time()
+
+    def getlayout(self):
+        with self.lock:
+            if self.layout is None:
+                starts, afters = [ 0 ], [ 0 ]
+                while True:
+                    records = db.catalogRecords(afters[-1], self.chunksize)
+                    size = starts[-1] + len(self.render(records, len(starts) == 1))
+                    if len(records) < self.chunksize:
+                        break
+                    starts.append(size)
+                    afters.append(records[-1]['id'])
+                movies = (len(starts) - 1) * self.chunksize + len(records)
+                self.permovie = float(size) / max(1, movies)
+                self.layout = (starts, afters, size, time())
+            return self.layout
+
+    def estimate(self):
+        """ A size at least that of the file, most likely, without rendering all of it. """
+        with self.lock:
+            if self.permovie is None:
+                # nothing laid out since the mount, a sample has to do
+                records = db.catalogRecords(0, self.chunksize)
+                self.permovie = float(len(self.render(records, True))) / max(1, len(records))
+            # one more for the csv header of an empty catalogue
+            return int(self.permovie * (db.movieCount() + 1) * self.headroom)
+
+    def chunk(self, layout, i):
+        last = self.last
+        if last[0] is not layout or last[1] != i:
+            last = self.last = (layout, i, self.render(db.catalogRecords(layout[1][i], self.chunksize), i == 0))
+        return last[2]
+
+    def getattr(self, pieces, fh=None):
+        if len(pieces) > 0:
             raise OSError(ENOENT, '')
-        return movies
+        layout = self.layout
+        if layout is not None:
+            size, built = layout[2], layout[3]
+        else:
+            size, built = self.estimate(), self.changed
+        st = {
+            'st_ino': inode(INO_FIXED, self.ino),
+            'st_mode': S_IFREG | 0444,
+            'st_size': size,
+            'st_nlink': 1,
+        }
+        st['st_ctime'] = st['st_mtime'] = st['st_atime'] = built
+        return st
+
+    def open(self, pieces, flags):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise OSError(EROFS, '')
+        # a client that fstat()s the open file gets the exact size
+        self.getlayout()
+        return 0
+
+    def read(self, pieces, size, offset, fh=None):
+        layout = self.getlayout()
+        starts = layout[0]
+        end = min(offset + size, layout[2])
+        data = [ ]
+        i = bisect.bisect_right(starts, offset) - 1
+        while offset < end and i < len(starts):
+            chunk = self.chunk(layout, i)
+            data.append(chunk[offset - starts[i]:end - starts[i]])
+            offset = starts[i] + len(chunk)
+            i += 1
+        return ''.join(data)
+
+class PathNode(object):
+    """
+      A resolved path: the object that handles it, the pieces of the path
+      that are handed down to it, and the name and depth it is accounted
+      under in statistics and profiles.
+    """
+    __slots__ = ('fs', 'handler', 'pieces', 'prefix')
 
-    levels = [ level_one, level_two ]
+    def __init__(self, fs, handler, pieces, prefix):
+        self.fs = fs
+        self.handler = handler
+        self.pieces = pieces
+        self.prefix = prefix
 
 # can't use LoggingMixIn, because we overwrite __call__ ourself!
 class MovieFS(Operations):
@@ -232,59 +679,127 @@ class MovieFS(Operations):
     Top-Level movie filesystem, this is what gets mounted. This is mainly
     plumbing to delegate calls down to the different sub-filesystems.
     """
-    def __init__(self, pathbase, db):
+    def __init__(self, pathbase, db, prefetcher=None, passthrough=False, artworkstore=None, monitor=None):
         self.pathbase = pathbase
         self.db = db
 
-        self.dir_patterns = {
-            'title':     TitleFS(pathbase, db),
-            'actor':     ActorFS(pathbase, db),
-            'director':  DirectorFS(pathbase, db),
-            'genre':     GenreFS(pathbase, db),
-            'year':      YearFS(pathbase, db),
-            'imdb':      ImdbFS(pathbase, db),
-            'runtime':   RuntimeFS(pathbase, db),
+        self.dir_patterns = dict((name, FacetFS(facet, pathbase, db)) for name, facet in facets.iteritems())
+
+        self.stats = Stats()
+        # a stats.Profiler while profiling is switched on
+        self.profiler = None
+        # a traces.TraceWriter while calls are recorded
+        self.tracer = None
+
+        # plain files in the root directory
+        self.files = {
+            '.stats':        GeneratedFile(lambda: self.stats.render(self), 2),
+            'catalog.jsonl': CatalogFile(catalogJson, 3),
+            'catalog.csv':   CatalogFile(catalogCsv, 4),
         }
+        self.rootnames = EncodedNames(['.', '..' ] + self.dir_patterns.keys() + self.files.keys())
+
+        # resolved paths, and how many of them to keep
+        self.nodes = { }
+        self.maxnodes = 100000
+
+        # the database is checked for commits of others at most every
+        # dbinterval seconds, everything cached is dropped after one
+        self.dbinterval = 1.0
+        self.dbchecked = 0
+        self.dbversion = None
+        self.invalidations = 0
+
+        if prefetcher is not None:
+            prefetcher.start()
+        for fs in self.dir_patterns.values():
+            fs.prefetcher = prefetcher
+            fs.passthrough = passthrough
+            fs.artworkstore = artworkstore
+            fs.monitor = monitor
+
+    def checkdb(self):
+        self.dbchecked = time()
+        version = db.dataVersion()
+        if self.dbversion is not None and version != self.dbversion:
+            db.invalidate()
+            for fs in self.dir_patterns.values():
+                fs.levelCache.clear()
+            for f in self.files.values():
+                if isinstance(f, CatalogFile):
+                    f.invalidate()
+            self.invalidations += 1
+        self.dbversion = version
+
+    def resolve(self, path):
+        """ Returns the PathNode of a path, creating it on first use. """
+        node = self.nodes.get(path)
+        if node is not None:
+            return node
+        # root is the only directory we handle in this class
+        if path == '/':
+            node = PathNode('/', self, path, '/')
+        # for everything else, consult the seven wise regexes
+        else:
+            pieces = tuple(x.decode('utf-8') for x in path.split('/')[1:])
+            if pieces[0] in self.files:
+                handler = self.files[pieces[0]]
+            elif pieces[0] in self.dir_patterns:
+                handler = self.dir_patterns[pieces[0]]
+            else:
+                raise OSError(ENOENT, '')
+            node = PathNode(pieces[0], handler, pieces[1:], pieces[0] + '/*' * (len(pieces) - 1))
+        if len(self.nodes) >= self.maxnodes:
+            self.nodes.clear()
+        self.nodes[path] = node
+        return node
 
     def __call__(self, op, path, *args):
         """ Delegate calls down to the different file systems.
-            This function basically takes the first element of the requested
-            op's path, and hands down the op call to the associated sub fs
-            from the dir_patterns dict.
+            This function resolves the requested op's path to the associated
+            sub fs from the dir_patterns dict, and hands down the op call
+            along with the rest of the path.
         """
         ret = '[Unhandled Exception]'
+        fs = '/'
+        failed = True
+        started = time()
         try:
-            # root is the only directory we handle in this class
-            if path == '/':
-                # print '->', op, path, repr(args)
-                ret = getattr(self, op)(path, *args)
-            # for everything else, consult the seven wise regexes
-            else:
-                pieces = list(x.decode('utf-8') for x in path.split('/')[1:])
-                if pieces[0] not in self.dir_patterns:
-                    # print '!>', op, path, repr(args)
-                    raise OSError(ENOENT, '')
-                # print '~>', self.dir_patterns[pieces[0]], op, path, repr(args)
-                ret = getattr(self.dir_patterns[pieces[0]], op)(pieces[1:], *args)
-            # do some encoding magic here
-            if isinstance(ret, list):
-                ret = list(x.encode('utf-8') for x in ret)
+            if self.tracer is not None:
+                self.tracer.record(op, path, args)
+            if started - self.dbchecked >= self.dbinterval:
+                self.checkdb()
+            node = self.resolve(path)
+            fs = node.fs
+            # print '~>', node.handler, op, path, repr(args)
+            # the SIGUSR1 handler may switch profiling between any two
+            # bytecodes, so look at self.profiler only once
+            profiler = self.profiler
+            if profiler is None:
+                ret = getattr(node.handler, op)(node.pieces, *args)
             else:
-                try:
-                    ret = ret.encode('utf-8')
-                except AttributeError:
-                    pass
+                ret = profiler.call(op, node.prefix, getattr(node.handler, op), (node.pieces, ) + args)
+            # do some encoding magic here. plain strings are left alone, they
+            # may well be binary file contents
+            if isinstance(ret, EncodedNames):
+                pass
+            elif isinstance(ret, list):
+                ret = list(x.encode('utf-8') if isinstance(x, unicode) else x for x in ret)
+            elif isinstance(ret, unicode):
+                ret = ret.encode('utf-8')
+            failed = False
             return ret
         except OSError, e:
             ret = str(e)
             raise
         finally:
             # print '<-', op, repr(ret)
-            pass
+            self.stats.record(fs, op, time() - started, failed)
 
     def getattr(self, path, fh=None):
         """ This handles only the attributes of the root directory """
         st = {
+            'st_ino': inode(INO_FIXED, 1),
             'st_mode': S_IFDIR | 0755,
             'st_nlink': 2,
         }
@@ -293,9 +808,37 @@ class MovieFS(Operations):
 
     def readdir(self, path, fh):
         """ This handles only the file listing of the root directory """
-        return ['.', '..' ] + self.dir_patterns.keys()
-
-def mount(mountpoint, pathbase, db):
+        return self.rootnames
+
+def toggleprofiling(movfs, dumpdir):
+    """ Switches profiling of movfs on, or off and dumps the results. """
+    if movfs.profiler is None:
+        movfs.profiler = Profiler(dumpdir)
+        print "profiling started"
+    else:
+        profiler, movfs.profiler = movfs.profiler, None
+        print "profile written to", profiler.dump()
+
+def mount(mountpoint, pathbase, db, prefetch=0, passthrough=False, profiledir=None, artworkstore=None, inodes=False, trace=None):
     signal.signal(signal.SIGINT, signal.SIG_DFL)
-    fuse = FUSE(MovieFS(pathbase, db), mountpoint, foreground=True, nothreads=True, allow_other=True)
+    prefetcher = Prefetcher(prefetch) if prefetch > 0 else None
+    if artworkstore is not None:
+        artworkstore = os.path.abspath(artworkstore)
+    # movies without a root of their own are below pathbase
+    root_paths.update(db.query(Root.id, Root.path))
+    monitor = RootMonitor([ pathbase ] + root_paths.values())
+    for root in monitor.wait():
+        print "root offline:", root
+    movfs = MovieFS(pathbase, db, prefetcher, passthrough, artworkstore, monitor)
+    if profiledir is not None:
+        # python runs this in the main thread between any two bytecodes, which
+        # can be in the middle of a filesystem call
+        signal.signal(signal.SIGUSR1, lambda signum, frame: toggleprofiling(movfs, profiledir))
+    if trace is not None:
+        movfs.tracer = TraceWriter(trace)
+    try:
+        fuse = FUSE(movfs, mountpoint, foreground=True, nothreads=True, allow_other=True, use_ino=inodes)
+    finally:
+        if movfs.tracer is not None:
+            movfs.tracer.close()
 
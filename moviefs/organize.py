@@ -0,0 +1,265 @@
+import db
+import tmdb
+import dupes
+
+import os
+import json
+import ctypes
+import ctypes.util
+import Queue
+from errno import ENOENT, EEXIST, EIO, EXDEV, ENOSYS, EINVAL, EOPNOTSUPP
+from stat import S_IMODE
+from multiprocessing.pool import ThreadPool
+
+# bytes handed to the kernel per copy call
+chunksize = 64 << 20
+
+# whether copies are only checked by size and opensubtitles hash, which
+# covers the first and last 64k, instead of being compared in full
+sampled = False
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+def libcfunction(name, restype, *argtypes):
+    """ A function of libc, or None if this libc does not have it. """
+    function = getattr(libc, name, None)
+    if function is not None:
+        function.restype = restype
+        function.argtypes = argtypes
+    return function
+
+_copy_file_range = libcfunction('copy_file_range', ctypes.c_ssize_t,
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint)
+_sendfile = libcfunction('sendfile', ctypes.c_ssize_t,
+        ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t)
+
+def copy_file_range(fin, fout):
+    return _copy_file_range(fin, None, fout, None, chunksize, 0)
+
+def sendfile(fin, fout):
+    return _sendfile(fout, fin, None, chunksize)
+
+def readwrite(fin, fout):
+    data = os.read(fin, 1 << 20)
+    os.write(fout, data)
+    return len(data)
+
+# ways to copy, best first. all of them move both file offsets along, so
+# one can take over where another gave up
+copymethods = [ ]
+if _copy_file_range is not None:
+    copymethods.append(('copy_file_range', copy_file_range))
+if _sendfile is not None:
+    copymethods.append(('sendfile', sendfile))
+copymethods.append(('read/write', readwrite))
+
+# errors of a copy method that mean it can't be used for these files
+unsupported = [ EXDEV, ENOSYS, EINVAL, EOPNOTSUPP ]
+
+def copydata(src, dst):
+    """ Copies the contents of src to dst, inside the kernel where possible. Returns the method used. """
+    fin = os.open(src, os.O_RDONLY)
+    try:
+        fout = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            for name, call in copymethods:
+                try:
+                    while True:
+                        copied = call(fin, fout)
+                        if copied < 0:
+                            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+                        if copied == 0:
+                            break
+                    break
+                except OSError, e:
+                    if e.errno not in unsupported:
+                        raise
+            # the source is removed right after, the copy must be on disk
+            os.fsync(fout)
+            return name
+        finally:
+            os.close(fout)
+    finally:
+        os.close(fin)
+
+def verify(src, dst):
+    """
+      Whether dst has the contents of src. The source is removed after
+      this, so every byte is compared, unless sampled is set.
+    """
+    if os.path.getsize(src) != os.path.getsize(dst):
+        return False
+    if sampled:
+        try:
+            return tmdb.opensubtitleHashFile(src) == tmdb.opensubtitleHashFile(dst)
+        except ValueError:
+            # too small to be hashed, and cheap to compare in full
+            pass
+    return dupes.samecontent(src, dst)
+
+def transfer(src, dst):
+    """
+      Moves src to dst, renaming it on the same filesystem, otherwise
+      copying it under a temporary name first. Returns how the file was
+      moved, or 'done' if an interrupted run had already done so.
+    """
+    if not os.path.exists(src):
+        if os.path.exists(dst):
+            return 'done'
+        raise OSError(ENOENT, 'source is gone', src)
+    if os.path.exists(dst):
+        # an interrupted run got the copy into place, but did not remove the source
+        if not verify(src, dst):
+            raise OSError(EEXIST, 'destination exists', dst)
+        os.unlink(src)
+        return 'done'
+    if not os.path.isdir(os.path.dirname(dst)):
+        try:
+            os.makedirs(os.path.dirname(dst))
+        except OSError:
+            # another worker was faster
+            pass
+    st = os.stat(src)
+    if st.st_dev == os.stat(os.path.dirname(dst)).st_dev:
+        os.rename(src, dst)
+        return 'rename'
+    part = dst + '.part'
+    method = copydata(src, part)
+    os.chmod(part, S_IMODE(st.st_mode))
+    os.utime(part, (st.st_atime, st.st_mtime))
+    if not verify(src, part):
+        os.unlink(part)
+        raise IOError(EIO, 'copy differs from the source', dst)
+    os.rename(part, dst)
+    os.unlink(src)
+    return method
+
+def destination(movie):
+    """ Where the file of a movie belongs, as laid out by tmdb.moviedir. """
+    langs = sorted(x.name for x in movie.languages)
+    return os.path.join(tmdb.moviedir(movie.name, movie.res_x or 0, movie.res_y or 0, langs), os.path.basename(movie.path))
+
+def plan(movies, pathbase):
+    """
+      Plans the moves of the files of movies into place, pathbase is the
+      root of movies without one. Returns a list of dicts with the movie
+      id, src and dst of each move, and a list of (movie, reason) for files
+      that can't be moved.
+    """
+    conflicts = [ ]
+    targets = { }
+    for movie in movies:
+        src = db.moviePath(movie, pathbase).encode('utf-8')
+        dst = destination(movie).encode('utf-8')
+        if os.path.abspath(src) == os.path.abspath(dst):
+            continue
+        if not os.path.exists(src):
+            conflicts.append((movie, 'file not found: ' + src))
+        elif os.path.exists(dst):
+            conflicts.append((movie, 'destination exists: ' + dst))
+        else:
+            targets.setdefault(dst, [ ]).append((movie, src))
+
+    moves = [ ]
+    for dst, group in sorted(targets.iteritems()):
+        if len(group) > 1:
+            for movie, src in group:
+                conflicts.append((movie, 'destination shared with %d other files: %s' % (len(group) - 1, dst)))
+        else:
+            movie, src = group[0]
+            moves.append({ 'id': movie.id, 'src': src, 'dst': dst })
+    return moves, conflicts
+
+class Journal(object):
+    """
+      The moves of a run and which of them are done, one json object per
+      line, so an interrupted run can be resumed where it stopped.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.f = None
+        self.pending = 0
+
+    def load(self):
+        """ Returns the moves an earlier run did not finish. """
+        if not os.path.exists(self.fname):
+            return [ ]
+        moves = [ ]
+        done = set()
+        with open(self.fname) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # cut off when the run was interrupted
+                    continue
+                if entry.get('done'):
+                    done.add(entry['src'])
+                else:
+                    moves.append(entry)
+        return list(dict((str(k), v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in x.iteritems()) for x in moves if x['src'] not in done)
+
+    def start(self, moves):
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'w') as f:
+            for move in moves:
+                f.write(json.dumps(move) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.fname)
+        self.f = open(self.fname, 'a')
+        self.pending = len(moves)
+
+    def finish(self, move):
+        self.f.write(json.dumps({ 'src': move['src'], 'done': True }) + '\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pending -= 1
+
+    def close(self):
+        """ Closes the journal, removing it if nothing is left to do. """
+        self.f.close()
+        if self.pending == 0:
+            os.unlink(self.fname)
+
+def run(moves, root, journal, jobs=4):
+    """
+      Carries out moves into the db.Root root, yielding (move, method,
+      error) as each finishes. Files on the same source device are moved
+      one after another, those on different devices in parallel, on up to
+      jobs threads. The path of each moved movie is updated in the
+      database, and the move recorded in journal, right after the file is
+      in place.
+    """
+    groups = { }
+    for move in moves:
+        try:
+            device = os.stat(move['src']).st_dev
+        except OSError:
+            device = None
+        groups.setdefault(device, [ ]).append(move)
+
+    results = Queue.Queue()
+    def work(group):
+        for move in group:
+            try:
+                results.put((move, transfer(move['src'], move['dst']), None))
+            except Exception, e:
+                # anything else would leave the main thread waiting forever
+                results.put((move, None, e))
+
+    pool = ThreadPool(max(1, min(jobs, len(groups))))
+    pool.map_async(work, groups.values())
+    pool.close()
+    for i in range(len(moves)):
+        move, method, error = results.get()
+        if error is None:
+            movie = db.session.query(db.Movie).get(move['id'])
+            if movie is not None:
+                movie.root_id = root.id
+                movie.path = os.path.relpath(move['dst'], root.path.encode('utf-8')).decode('utf-8')
+                db.session.commit()
+            journal.finish(move)
+        yield move, method, error
+    pool.join()
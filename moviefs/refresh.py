@@ -0,0 +1,134 @@
+import db
+import tmdb
+
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+
+# movie fields taken from tmdb as they are, and those that are numbers
+fields = [ 'name', 'homepage', 'imdb_id', 'tagline' ]
+numbers = [ 'runtime', 'budget', 'revenue' ]
+
+def stale(days):
+    """ Returns the movies whose info was fetched more than days ago, or never. """
+    before = datetime.now() - timedelta(days=days)
+    return db.session.query(db.Movie).options(*db.eagerly).filter(db.or_(db.Movie.fetched == None, db.Movie.fetched < before)).all()
+
+def fetch(job):
+    movie_id, etag, modified = job
+    try:
+        return movie_id, tmdb.MovieDb().getMovieInfo(movie_id, etag, modified), None
+    except tmdb.TmdNotModified:
+        return movie_id, None, None
+    except Exception, e:
+        # a dropped connection or a malformed response spoils this movie
+        # only, not the whole refresh
+        return movie_id, None, e
+
+class People(object):
+    """ All actors or directors, so casts are matched without a query per person. """
+
+    def __init__(self, model):
+        self.model = model
+        self.byid = { }
+        self.byname = { }
+        for person in db.session.query(model):
+            self.byid[person.id] = person
+            self.byname[person.name] = person
+
+    def get(self, ident, name):
+        person = self.byid.get(int(ident)) or self.byname.get(name)
+        if person is None:
+            person = self.model(int(ident), name)
+            db.session.add(person)
+            self.byid[person.id] = person
+            self.byname[name] = person
+        return person
+
+def related(movie, attr, new, changes):
+    """ Sets a relationship of movie to the list new, noting added and removed names. """
+    old = set(x.name for x in getattr(movie, attr))
+    names = set(x.name for x in new)
+    if old == names:
+        return
+    setattr(movie, attr, new)
+    changes.append("%s: %s" % (attr, ', '.join([ '+' + x for x in sorted(names - old) ] + [ '-' + x for x in sorted(old - names) ])))
+
+def update(movie, info, actors, directors, genres):
+    """
+      Applies fetched info to movie, returns a list of the changes. What
+      the response lacks is left as it is, not cleared.
+    """
+    changes = [ ]
+    for field in fields + numbers:
+        if field not in info:
+            continue
+        value = info[field]
+        if value is not None and field in numbers:
+            value = int(value)
+        if value != getattr(movie, field):
+            changes.append("%s: %s -> %s" % (field, getattr(movie, field), value))
+            setattr(movie, field, value)
+    if info.get('released') is not None:
+        released = datetime.strptime(info['released'], '%Y-%m-%d')
+        if released != movie.released:
+            changes.append("released: %s -> %s" % (movie.released.strftime('%Y-%m-%d') if movie.released else None, info['released']))
+            movie.released = released
+            movie.year = released.year
+
+    cast = info.get('cast', { })
+    if 'actor' in cast:
+        related(movie, 'actors', list(actors.get(x['id'], x['name']) for x in cast['actor']), changes)
+    if 'director' in cast:
+        related(movie, 'directors', list(directors.get(x['id'], x['name']) for x in cast['director']), changes)
+    categories = info.get('categories', { })
+    if 'genre' in categories:
+        new = [ ]
+        for name, url in categories['genre'].iteritems():
+            if name not in genres:
+                genres[name] = db.Genre(name, url)
+                db.session.add(genres[name])
+            new.append(genres[name])
+        related(movie, 'genres', new, changes)
+    return changes
+
+def refresh(movies, jobs=4):
+    """
+      Fetches the info of movies from tmdb again and updates them. Requests
+      are conditional where tmdb sent validators before, and run in jobs
+      threads, so set tmdb.limiter to stay within the api's rate limit.
+      The database is only touched from this thread, and committed once.
+
+      Returns a list of (movie, [ change, ... ]) for the movies that
+      changed, and a dict counting them, the unchanged and not modified
+      ones and the errors, which are listed in it as (movie, error).
+    """
+    byid = dict((x.id, x) for x in movies)
+    actors = People(db.Actor)
+    directors = People(db.Director)
+    genres = dict((x.name, x) for x in db.session.query(db.Genre))
+
+    changed = [ ]
+    stats = { 'changed': 0, 'unchanged': 0, 'notmodified': 0, 'errors': [ ] }
+    pool = ThreadPool(jobs)
+    try:
+        for movie_id, info, error in pool.imap_unordered(fetch, list((x.id, x.etag, x.modified) for x in movies)):
+            movie = byid[movie_id]
+            if error is not None:
+                stats['errors'].append((movie, error))
+                continue
+            movie.fetched = datetime.now()
+            if info is None:
+                stats['notmodified'] += 1
+                continue
+            movie.etag = info.get('etag')
+            movie.modified = info.get('modified')
+            changes = update(movie, info, actors, directors, genres)
+            if len(changes) > 0:
+                changed.append((movie, changes))
+                stats['changed'] += 1
+            else:
+                stats['unchanged'] += 1
+    finally:
+        pool.close()
+        db.session.commit()
+    return changed, stats
@@ -0,0 +1,175 @@
+import db
+
+import io
+import os
+import gzip
+import json
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+# the version of snapshots written, and the newest one that can be read
+version = 1
+
+# the catalogue, referenced tables first. file hashes, the review queue and
+# the search cache are about the files and searches of one host, and stay
+tables = [ 'roots', 'actors', 'directors', 'genres', 'languages', 'movies',
+           'movie_actors', 'movie_directors', 'movie_genres', 'movie_languages', 'artwork' ]
+
+# rows read, written and inserted at a time
+batchsize = 10000
+
+class SnapshotError(Exception):
+    pass
+
+dumps = json.JSONEncoder(separators=(',', ':')).encode
+
+def export(fname):
+    """
+      Writes the catalogue to fname as gzip'ed json lines: a header with the
+      format version, then for each table a line naming its columns,
+      followed by one array per row. Values are written as sqlite stores
+      them, straight from the cursor, so memory use does not grow with the
+      catalogue. Returns the number of rows per table.
+    """
+    conn = db.session.connection().connection
+    counts = { }
+    tmp = fname + '.tmp'
+    out = gzip.open(tmp, 'wb', 6)
+    complete = False
+    try:
+        out.write(dumps({ 'format': 'moviefs', 'version': version }) + '\n')
+        for table in tables:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM %s' % table)
+            out.write(dumps({ 'table': table, 'columns': list(x[0] for x in cursor.description) }) + '\n')
+            counts[table] = 0
+            while True:
+                rows = cursor.fetchmany(batchsize)
+                if len(rows) == 0:
+                    break
+                out.write(''.join(dumps(x) + '\n' for x in rows))
+                counts[table] += len(rows)
+            cursor.close()
+        complete = True
+    finally:
+        out.close()
+        # a snapshot is either complete or not there
+        if not complete:
+            os.remove(tmp)
+    os.rename(tmp, fname)
+    return counts
+
+def decode(lines):
+    # one call for many rows is a lot faster than one per row
+    try:
+        return json.loads('[' + ','.join(lines) + ']')
+    except ValueError:
+        raise SnapshotError("the snapshot is damaged")
+
+def readheader(f):
+    """ Reads the header of an open snapshot, raises SnapshotError unless it can be read. """
+    try:
+        header = json.loads(f.readline())
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or header.get('format') != 'moviefs' or not isinstance(header.get('version'), int):
+        raise SnapshotError("not a snapshot")
+    if header['version'] > version:
+        raise SnapshotError("snapshot version %d is newer than this moviefs, which reads up to %d" % (header['version'], version))
+    return header
+
+def records(f):
+    """
+      Yields what an open snapshot, past its header, holds: for each table
+      a dict with its name and columns, followed by its rows in lists of up
+      to batchsize.
+    """
+    lines = [ ]
+    for line in f:
+        if line.startswith('{'):
+            if len(lines) > 0:
+                yield decode(lines)
+                lines = [ ]
+            yield decode([ line ])[0]
+            continue
+        lines.append(line)
+        if len(lines) >= batchsize:
+            yield decode(lines)
+            lines = [ ]
+    if len(lines) > 0:
+        yield decode(lines)
+
+def restore(fname):
+    """
+      Loads a snapshot into an empty database, in one transaction, which
+      also creates the tables of a new one. Indexes are dropped before and
+      built again after the rows are in, which is much faster than
+      updating them row by row. Columns the snapshot has but the schema no
+      longer does are left out, those it lacks stay empty, except for
+      derived ones that are filled in. Returns the number of rows per
+      table, and the left out columns as a list of 'table.column'.
+    """
+    engine = db.getEngine()
+    schema = dict((x.name, x) for x in db.Base.metadata.sorted_tables)
+    indexes = list(x for table in db.Base.metadata.sorted_tables for x in table.indexes)
+
+    # gzip's own readline is slow
+    f = io.BufferedReader(gzip.open(fname, 'rb'), 1 << 20)
+    try:
+        # nothing is touched for a file that is not a snapshot
+        readheader(f)
+
+        fairy = engine.raw_connection()
+        conn = fairy.connection
+        # the sqlite module commits on its own before schema changes, which
+        # would split the transaction
+        isolation = conn.isolation_level
+        conn.isolation_level = None
+        cursor = conn.cursor()
+        counts = { }
+        dropped = [ ]
+        sql = None
+        try:
+            cursor.execute('BEGIN')
+            existing = set(x[0] for x in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+            for table in db.Base.metadata.sorted_tables:
+                if table.name not in existing:
+                    cursor.execute(unicode(CreateTable(table).compile(dialect=engine.dialect)))
+            if cursor.execute('SELECT count(*) FROM movies').fetchone()[0] > 0:
+                raise SnapshotError("the database has movies already, import into a new one")
+            for index in indexes:
+                cursor.execute('DROP INDEX IF EXISTS %s' % index.name)
+
+            for record in records(f):
+                if isinstance(record, dict):
+                    table, columns = record.get('table'), record.get('columns')
+                    if table not in schema:
+                        raise SnapshotError("unknown table %s" % table)
+                    if not isinstance(columns, list):
+                        raise SnapshotError("the snapshot is damaged")
+                    known = set(schema[table].columns.keys())
+                    keep = list(i for i, x in enumerate(columns) if x in known)
+                    dropped.extend(table + '.' + x for x in columns if x not in known)
+                    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join(columns[i] for i in keep), ', '.join('?' * len(keep)))
+                    counts[table] = 0
+                    continue
+                if sql is None:
+                    raise SnapshotError("the snapshot is damaged")
+                if len(keep) < len(columns):
+                    record = list(list(row[i] for i in keep) for row in record)
+                cursor.executemany(sql, record)
+                counts[table] += len(record)
+
+            for index in indexes:
+                cursor.execute(unicode(CreateIndex(index).compile(dialect=engine.dialect)))
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        finally:
+            cursor.close()
+            conn.isolation_level = isolation
+            fairy.close()
+    finally:
+        f.close()
+    db.backfillResolutions()
+    return counts, dropped
@@ -0,0 +1,135 @@
+import db
+
+import os
+import cProfile
+import pstats
+from time import time, strftime
+
+# upper bounds of the latency histogram buckets, in seconds
+buckets = [ 0.0001, 0.001, 0.01, 0.1, 1 ]
+bucketnames = [ '<0.1ms', '<1ms', '<10ms', '<100ms', '<1s', '>=1s' ]
+
+class OpStats(object):
+    """ Call count, error count and latency histogram of a single operation. """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.histogram = [ 0 ] * (len(buckets) + 1)
+
+    def add(self, elapsed, failed):
+        self.count += 1
+        if failed:
+            self.errors += 1
+        self.total += elapsed
+        i = 0
+        while i < len(buckets) and elapsed >= buckets[i]:
+            i += 1
+        self.histogram[i] += 1
+
+    def line(self, prefix):
+        return "{} count {} errors {} avg_ms {:.3f} {}".format(prefix, self.count, self.errors,
+                1000 * self.total / max(1, self.count),
+                ' '.join('{}:{}'.format(bucketnames[i], self.histogram[i]) for i in range(len(self.histogram))))
+
+class Stats(object):
+    """
+      Statistics of a running mount. MovieFS records each call here, and the
+      whole thing is rendered into the /.stats file on every read.
+
+      The output is one record per line, a name followed by key/value pairs,
+      so it is readable with cat and trivial to scrape.
+    """
+
+    # operations that are always listed, even before they were called
+    ops = [ 'getattr', 'readdir', 'read', 'readlink' ]
+
+    def __init__(self):
+        self.started = time()
+        # (sub-filesystem, op) -> OpStats, the root has an fs of '/'
+        self.calls = { }
+
+    def record(self, fs, op, elapsed, failed):
+        key = (fs, op)
+        if key not in self.calls:
+            self.calls[key] = OpStats()
+        self.calls[key].add(elapsed, failed)
+
+    def render(self, moviefs):
+        lines = [ ]
+        lines.append("uptime {:.0f}".format(time() - self.started))
+        lines.append("queries {}".format(db.query_stats['queries']))
+        lines.append("invalidations {}".format(moviefs.invalidations))
+
+        ops = set(self.ops) | set(op for _, op in self.calls)
+        for op in sorted(ops):
+            total = OpStats()
+            for (fs, o), st in self.calls.iteritems():
+                if o != op:
+                    continue
+                total.count += st.count
+                total.errors += st.errors
+                total.total += st.total
+                total.histogram = list(a + b for a, b in zip(total.histogram, st.histogram))
+            lines.append(total.line("op " + op))
+        for fs, op in sorted(self.calls):
+            lines.append(self.calls[(fs, op)].line("fs {} {}".format(fs, op)))
+
+        for name, fs in sorted(moviefs.dir_patterns.iteritems()):
+            hits, misses = fs.cacheStats['hits'], fs.cacheStats['misses']
+            lines.append("cache levelCache {} entries {} hits {} misses {} coalesced {} hitrate {:.3f}".format(
+                name, len(fs.levelCache), hits, misses, fs.flights.coalesced, float(hits) / max(1, hits + misses)))
+        hits, misses = db.movie_cache_stats['hits'], db.movie_cache_stats['misses']
+        lines.append("cache movie_cache entries {} hits {} misses {} coalesced {} hitrate {:.3f}".format(
+            len(db.movie_cache), hits, misses, db.movie_flights.coalesced, float(hits) / max(1, hits + misses)))
+        lines.append("cache movie_info entries {}".format(len(db.movie_info)))
+        lines.append("cache movie_nfo entries {}".format(len(db.movie_nfo)))
+        lines.append("prefetch " + ' '.join('{} {}'.format(k, v) for k, v in sorted(db.prefetch_stats.iteritems())))
+
+        return '\n'.join(lines) + '\n'
+
+class Profiler(object):
+    """
+      Profiles the calls dispatched by MovieFS, keeping a separate profile
+      for each operation and path prefix. The prefix is the sub-filesystem
+      followed by one * per further path level, so e.g. listings of genres
+      (genre/*) and of movie directories (genre/*/*) are told apart.
+    """
+
+    def __init__(self, dumpdir):
+        self.dumpdir = dumpdir
+        self.started = time()
+        # (op, prefix) -> [ cProfile.Profile, number of calls ]
+        self.profiles = { }
+
+    def call(self, op, prefix, handler, args):
+        key = (op, prefix)
+        if key not in self.profiles:
+            self.profiles[key] = [ cProfile.Profile(), 0 ]
+        self.profiles[key][1] += 1
+        return self.profiles[key][0].runcall(handler, *args)
+
+    def dump(self):
+        """
+          Writes one pstats file per operation and prefix, plus a summary.txt
+          listing them by total time, each with its top functions. Returns
+          the directory everything was written to.
+        """
+        outdir = os.path.join(self.dumpdir, 'moviefs-profile-' + strftime('%Y%m%d-%H%M%S'))
+        os.makedirs(outdir)
+        ranked = [ ]
+        for (op, prefix), (profile, calls) in self.profiles.iteritems():
+            name = '{}-{}'.format(op, prefix.replace('/', '_').replace('*', 'x'))
+            profile.dump_stats(os.path.join(outdir, name + '.prof'))
+            ranked.append((pstats.Stats(profile).total_tt, op, prefix, calls, name))
+        ranked.sort(reverse=True)
+        with open(os.path.join(outdir, 'summary.txt'), 'w') as f:
+            f.write("profiled for {:.0f}s\n\n".format(time() - self.started))
+            for total, op, prefix, calls, name in ranked:
+                f.write("{} {} calls {} total_ms {:.1f} avg_ms {:.3f}\n".format(op, prefix, calls, 1000 * total, 1000 * total / max(1, calls)))
+            for total, op, prefix, calls, name in ranked:
+                f.write("\n==== {} {} ({}.prof)\n".format(op, prefix, name))
+                st = pstats.Stats(os.path.join(outdir, name + '.prof'), stream=f)
+                st.sort_stats('cumulative').print_stats(15)
+        return outdir
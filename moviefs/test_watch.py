@@ -0,0 +1,101 @@
+import watch
+
+import os
+import shutil
+import tempfile
+import unittest
+from time import time
+
+class WatcherTest(unittest.TestCase):
+    """ Drives a Watcher on a temporary library root, with a stand-in for the ingest. """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.ingested = [ ]
+        self.watcher = None
+
+    def tearDown(self):
+        if self.watcher is not None:
+            self.watcher.close()
+        shutil.rmtree(self.root)
+
+    def start(self, known=(), ingest=None, **settings):
+        self.watcher = watch.Watcher([ self.root ], ingest or self.ingested.append, known)
+        self.watcher.settle = settings.get('settle', 0.2)
+        self.watcher.interval = 0.05
+        self.watcher.maxpending = settings.get('maxpending', 100)
+        return self.watcher
+
+    def run_until(self, done, timeout=5.0):
+        deadline = time() + timeout
+        self.watcher.run(lambda: done() or time() > deadline)
+
+    def write(self, *pieces):
+        path = os.path.join(self.root, *pieces)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write('video')
+        return path
+
+    def test_new_file(self):
+        self.start()
+        path = self.write('Movie (2001)', 'movie.mkv')
+        self.write('Movie (2001)', 'notes.txt')
+        self.run_until(lambda: len(self.ingested) > 0)
+        self.assertEqual(self.ingested, [ path ])
+
+    def test_existing_and_known_files(self):
+        old = self.write('old.avi')
+        known = self.write('known.mkv')
+        self.start(known=[ known ])
+        self.run_until(lambda: len(self.ingested) > 0)
+        self.assertEqual(self.ingested, [ old ])
+
+    def test_growing_file_waits(self):
+        watcher = self.start(settle=0.5)
+        path = self.write('growing.mkv')
+        started = time()
+        for i in range(5):
+            self.run_until(lambda: False, 0.1)
+            with open(path, 'ab') as f:
+                f.write('more')
+        self.assertEqual(self.ingested, [ ])
+        self.run_until(lambda: len(self.ingested) > 0)
+        self.assertEqual(self.ingested, [ path ])
+        self.assertTrue(time() - started >= 0.5 + watcher.settle)
+
+    def test_moved_in_directory(self):
+        self.start()
+        outside = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(outside, 'Movie'))
+            with open(os.path.join(outside, 'Movie', 'movie.mp4'), 'wb') as f:
+                f.write('video')
+            os.rename(os.path.join(outside, 'Movie'), os.path.join(self.root, 'Movie'))
+        finally:
+            shutil.rmtree(outside)
+        self.run_until(lambda: len(self.ingested) > 0)
+        self.assertEqual(self.ingested, [ os.path.join(self.root, 'Movie', 'movie.mp4') ])
+
+    def test_burst_beyond_maxpending(self):
+        watcher = self.start(maxpending=3)
+        paths = set(self.write('burst', '%02d.mkv' % i) for i in range(10))
+        self.run_until(lambda: len(self.ingested) == len(paths))
+        self.assertEqual(set(self.ingested), paths)
+        self.assertTrue(watcher.stats['maxpending'] <= 3)
+
+    def test_failed_ingest_goes_on(self):
+        def ingest(path):
+            if path.endswith('bad.mkv'):
+                raise ValueError("no match")
+            self.ingested.append(path)
+        watcher = self.start(ingest=ingest)
+        self.write('bad.mkv')
+        good = self.write('good.mkv')
+        self.run_until(lambda: len(self.ingested) > 0)
+        self.assertEqual(self.ingested, [ good ])
+        self.assertEqual(watcher.stats['failed'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
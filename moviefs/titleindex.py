@@ -0,0 +1,114 @@
+import db
+import tmdb
+
+import re
+
+def normalize(title):
+    return ' '.join(re.sub(r'[\W_]+', ' ', title.lower(), flags=re.UNICODE).split())
+
+def trigrams(title):
+    padded = '  ' + normalize(title) + ' '
+    return set(padded[i:i+3] for i in range(len(padded) - 2))
+
+class TitleIndex(object):
+    """
+      A trigram index over movie titles, used to save title searches on
+      tmdb. It knows the movies in the database and everything tmdb
+      returned for earlier searches, which are kept in the search_cache
+      table.
+
+      A search is answered locally if the very same title was searched
+      before, or if known titles are similar to it, by the jaccard index
+      of their trigram sets, and were released in the year the file name
+      mentions. Similar titles alone are not enough: a remake shares its
+      title with a movie that is known already.
+    """
+
+    # titles at least this similar to a search are taken as matches
+    threshold = 0.85
+
+    def __init__(self):
+        # tmdb id -> dict with id, name and released, like a search result
+        self.entries = { }
+        # trigram -> set of tmdb ids
+        self.grams = { }
+        # tmdb id -> number of trigrams of its title
+        self.sizes = { }
+        # normalized title -> list of tmdb ids it was found as, on tmdb
+        self.queries = { }
+        self.stats = { 'local': 0, 'remote': 0 }
+
+    def load():
+        index = TitleIndex()
+        for ident, name, released in db.session.query(db.Movie.id, db.Movie.name, db.Movie.released):
+            index.add(ident, name, released.strftime('%Y-%m-%d') if released is not None else None)
+        for cached in db.session.query(db.SearchCache):
+            ids = index.queries.setdefault(cached.query, [ ])
+            if cached.movie_id != 0:
+                index.add(cached.movie_id, cached.name, cached.released)
+                if cached.movie_id in index.entries:
+                    ids.append(cached.movie_id)
+        return index
+    load = staticmethod(load)
+
+    def add(self, ident, name, released):
+        ident = int(ident)
+        if ident in self.entries or not name:
+            return
+        self.entries[ident] = { 'id': unicode(ident), 'name': name, 'released': released }
+        grams = trigrams(name)
+        self.sizes[ident] = len(grams)
+        for gram in grams:
+            self.grams.setdefault(gram, set()).add(ident)
+
+    def lookup(self, title):
+        """ Returns (similarity, tmdb id) of all titles similar to title, best first. """
+        grams = trigrams(title)
+        shared = { }
+        for gram in grams:
+            for ident in self.grams.get(gram, ()):
+                shared[ident] = shared.get(ident, 0) + 1
+        matches = [ ]
+        for ident, count in shared.iteritems():
+            similarity = float(count) / (len(grams) + self.sizes[ident] - count)
+            if similarity >= self.threshold:
+                matches.append((similarity, ident))
+        matches.sort(reverse=True)
+        return matches
+
+    def results(self, ids):
+        return tmdb.SearchResults(tmdb.MovieResult(self.entries[x]) for x in ids)
+
+    def search(self, title, year=None):
+        """
+          Returns search results for title like tmdb.search, or None if it
+          has to be asked. year is the release year guessed from the file
+          name, without one only repeated searches are answered.
+        """
+        key = normalize(title)
+        if key in self.queries:
+            ids = self.queries[key]
+        elif year is not None:
+            ids = list(x[1] for x in self.lookup(title) if (self.entries[x[1]]['released'] or '')[:4] == str(year))
+            if len(ids) == 0:
+                return None
+        else:
+            return None
+        self.stats['local'] += 1
+        return self.results(ids)
+
+    def learn(self, title, results):
+        """ Remembers the results tmdb returned for a search. """
+        self.stats['remote'] += 1
+        key = normalize(title)
+        if key in self.queries:
+            return
+        self.queries[key] = [ ]
+        for result in results:
+            self.add(result['id'], result.get('name'), result.get('released'))
+            if int(result['id']) in self.entries:
+                self.queries[key].append(int(result['id']))
+            db.session.merge(db.SearchCache(key, int(result['id']), result.get('name'), result.get('released')))
+        if len(results) == 0:
+            db.session.merge(db.SearchCache(key, 0, None, None))
+        db.session.commit()
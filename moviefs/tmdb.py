@@ -28,6 +28,9 @@ import struct
 import urllib
 import urllib2
 import subprocess
+import difflib
+import threading
+import time
 
 import xml.etree.cElementTree as ElementTree
 
@@ -46,6 +49,10 @@ class TmdHttpError(TmdBaseError):
     pass
 
 
+class TmdNotModified(TmdBaseError):
+    pass
+
+
 class TmdXmlError(TmdBaseError):
     pass
 
@@ -88,20 +95,64 @@ def opensubtitleHashFile(name):
     return  "%016x" % fhash
 
 
+class RateLimiter(object):
+    """Spaces out requests to at most rate per second on average, across all
+    threads, letting through bursts of up to burst requests
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # going below zero reserves a slot in the future for this request
+            self.tokens -= 1
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+# a RateLimiter all api requests wait for, if set
+limiter = None
+
+
 class XmlHandler:
     """Deals with retrieval of XML files from API
     """
 
-    def __init__(self, url):
+    def __init__(self, url, etag=None, modified=None):
         self.url = url
+        # validators of an earlier response, which make the request
+        # conditional, and afterwards those of this one
+        self.etag = etag
+        self.modified = modified
 
     def _grabUrl(self, url):
+        if limiter is not None:
+            limiter.wait()
+        request = urllib2.Request(url)
+        if self.etag is not None:
+            request.add_header('If-None-Match', self.etag)
+        if self.modified is not None:
+            request.add_header('If-Modified-Since', self.modified)
         try:
-            urlhandle = urllib2.urlopen(url)
+            urlhandle = urllib2.urlopen(request)
+        except urllib2.HTTPError, errormsg:
+            if errormsg.code == 304:
+                raise TmdNotModified(url)
+            raise TmdHttpError(errormsg)
         except IOError, errormsg:
             raise TmdHttpError(errormsg)
         if urlhandle.code >= 400:
             raise TmdHttpError("HTTP status code was %d" % urlhandle.code)
+        self.etag = urlhandle.info().getheader('ETag')
+        self.modified = urlhandle.info().getheader('Last-Modified')
         return urlhandle.read()
 
     def getEt(self):
@@ -212,6 +263,7 @@ class Image(dict):
     def __init__(self, _id, _type, size, url):
         self['id'] = _id
         self['type'] = _type
+        self[size] = url
 
     def largest(self):
         for csize in ["original", "mid", "cover", "thumb"]:
@@ -380,18 +432,24 @@ class MovieDb:
             search_results.append(cur_movie)
         return search_results
 
-    def getMovieInfo(self, id):
+    def getMovieInfo(self, id, etag=None, modified=None):
         """Returns movie info by it's TheMovieDb ID.
-        Returns a Movie instance
+        Returns a Movie instance, with the etag and modified validators of
+        the response. If those of an earlier response are passed in and the
+        info did not change since, raises TmdNotModified
         """
         url = config['urls']['movie.getInfo'] % (id)
-        etree = XmlHandler(url).getEt()
+        handler = XmlHandler(url, etag, modified)
+        etree = handler.getEt()
         moviesTree = etree.find("movies").findall("movie")
 
         if len(moviesTree) == 0:
             raise TmdNoResults("No results for id %s" % id)
 
-        return self._parseMovie(moviesTree[0])
+        movie = self._parseMovie(moviesTree[0])
+        movie['etag'] = handler.etag
+        movie['modified'] = handler.modified
+        return movie
 
     def mediaGetInfo(self, hash, size):
         """Used to retrieve specific information about a movie but instead of
@@ -445,6 +503,10 @@ def searchByHashingFile(filename):
     return mediaGetInfo(opensubtitleHashFile(filename), os.path.getsize(filename))
 
 stopwords = [ 'mkv', 'german', '720p', '1080p', 'hdtv', 'ac3', 'bluray', 'dts', 'h264', 'x264', 'rip', '196', '197', '198', '199', '200', '201', '(', '[' ]
+# an index of known titles, consulted before searching on tmdb. anything with
+# search(title) and learn(title, results), see titleindex.TitleIndex
+localindex = None
+
 def movieinfo(fname, guessname):
     miout = subprocess.check_output([ "midentify", fname ])
     attrs = { }
@@ -453,10 +515,19 @@ def movieinfo(fname, guessname):
             l, _, r = line.partition('=')
             attrs[l] = r
 
+    title = guessname.decode('utf-8')
+    results = None
+    if localindex is not None:
+        results = localindex.search(title, filenameyear(fname))
+    if results is None:
+        results = search(title)
+        if localindex is not None:
+            localindex.learn(title, results)
+
     return {
         'fname': fname,
         'guessname': guessname,
-        'movie': search(guessname.decode('utf-8')),
+        'movie': results,
         'attrs': attrs,
     }
 
@@ -464,37 +535,111 @@ path_base = '/home/shared/v/'
 path_hd = 'hd/'
 path_sd = 'movies/'
 
-def moviepath(info):
-    path = path_base
-
-    if int(info['attrs']['ID_VIDEO_WIDTH']) >= 1280 or int(info['attrs']['ID_VIDEO_HEIGHT']) >= 720:
-        path += path_hd
-    else:
-        path += path_sd
-
-    path += info['movie']['name'].replace(os.sep, ' ')
-
+def audiolanguages(attrs):
+    """Returns the sorted language codes of the audio tracks in probed attrs
+    """
     i = 0
     langs = []
-    while ('ID_AID_' + str(i) + '_LANG') in info['attrs']:
-        if info['attrs']['ID_AID_' + str(i) + '_LANG'] == 'deu':
+    while ('ID_AID_' + str(i) + '_LANG') in attrs:
+        if attrs['ID_AID_' + str(i) + '_LANG'] == 'deu':
             langs.append('ger')
         else:
-            langs.append(info['attrs']['ID_AID_' + str(i) + '_LANG'])
+            langs.append(attrs['ID_AID_' + str(i) + '_LANG'])
         i += 1
+    return sorted(langs)
+
+def moviedir(name, width, height, langs):
+    """Returns the directory a movie with this name, resolution and audio
+    languages belongs in
+    """
+    path = path_base
+
+    if width >= 1280 or height >= 720:
+        path += path_hd
+    else:
+        path += path_sd
 
-    langs = sorted(langs)
+    path += name.replace(os.sep, ' ')
 
     if len(langs) > 0:
         path += ' [' + ",".join(langs) + ']'
-    else:
-        print "No language info found."
 
     path += '/'
 
     return path
 
-def findmovieinfo(fname):
+def moviepath(info):
+    langs = audiolanguages(info['attrs'])
+    if len(langs) == 0:
+        print "No language info found."
+    return moviedir(info['movie']['name'], int(info['attrs']['ID_VIDEO_WIDTH']), int(info['attrs']['ID_VIDEO_HEIGHT']), langs)
+
+def filenameyear(fname):
+    """Returns the release year mentioned in a file name or its directory, or None
+    """
+    for piece in reversed(fname.split('/')[-2:]):
+        years = re.findall(r'(?<!\d)(19\d\d|20\d\d)(?!\d)', piece)
+        if years:
+            return int(years[-1])
+    return None
+
+def scorecandidate(info, candidate):
+    """Scores how well a search result matches a probed file, from title
+    similarity to the guessed name, the year in the file name and the
+    runtime of the video, where those are known. 1.0 is a perfect title
+    match, year and runtime add to or take from that.
+    """
+    name = (candidate.get('name') or '').lower()
+    score = difflib.SequenceMatcher(None, info['guessname'].lower(), name).ratio()
+
+    year = filenameyear(info['fname'])
+    released = candidate.get('released') or ''
+    if year is not None and released[:4].isdigit():
+        diff = abs(int(released[:4]) - year)
+        if diff == 0:
+            score += 0.3
+        elif diff == 1:
+            score += 0.1
+        else:
+            score -= 0.3
+
+    length = info['attrs'].get('ID_LENGTH')
+    runtime = candidate.get('runtime')
+    if length and runtime:
+        try:
+            ratio = float(length) / 60 / int(runtime)
+        except (ValueError, ZeroDivisionError):
+            pass
+        else:
+            if 0.95 <= ratio <= 1.05:
+                score += 0.2
+            elif not 0.85 <= ratio <= 1.15:
+                score -= 0.2
+
+    return score
+
+# a match is accepted without asking if it scores at least this..
+confident_score = 0.9
+# ..and beats the next best candidate by this much
+confident_margin = 0.2
+
+def choosemovie(info):
+    """Picks the search result in info that confidently matches the file,
+    returns None if there is no such result.
+    """
+    scored = sorted(((scorecandidate(info, x), x) for x in info['movie']), reverse=True)
+    if len(scored) == 0 or scored[0][0] < confident_score:
+        return None
+    if len(scored) > 1 and scored[0][0] - scored[1][0] < confident_margin:
+        return None
+    return scored[0][1]
+
+def findmovieinfo(fname, interactive=True):
+    """Probes a file and looks it up on tmdb, asking for help if there is
+    no single match. Unless interactive, the best match is chosen
+    automatically if it is a confident one. Otherwise the info is returned
+    with the search results still in info['movie'], for a later review.
+    """
     guessname = fname
     guessname = os.path.basename(fname).lower()
     guessname = guessname.replace('.', ' ').replace('-', ' ').replace('_',' ')
@@ -522,19 +667,26 @@ def findmovieinfo(fname):
     # get a name with proper info
     while True:
         if info is None or len(info['movie']) == 0:
+            # without a name to try, keep what the probe found for a review
             if guessname != '':
                 info = movieinfo(fname, guessname)
                 print "guessed name: ", info['guessname']
-            else:
-                info = None
 
         if info is None or len(info['movie']) == 0:
             print "Could not find a title match!"
+            if not interactive:
+                return info
             guessname = raw_input("Input Title (or empty to skip): ")
             if guessname != '':
                 continue
             return None
 
+        if not interactive:
+            best = choosemovie(info)
+            if best is not None:
+                info['movie'] = best
+            return info
+
         if len(info['movie']) == 1:
             info['movie'] = info['movie'][0]
             return info
@@ -0,0 +1,160 @@
+import os
+import gzip
+import threading
+import Queue
+from errno import ENOENT
+from time import time
+
+# operations that are recorded. they are replayed without file handles, so
+# a read stands for open, read and release of the file
+traced = frozenset([ 'getattr', 'readdir', 'readlink', 'read' ])
+
+def openfile(fname, mode):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, mode)
+    return open(fname, mode)
+
+class TraceWriter(object):
+    """
+      Records the calls a mount gets, one line per call: seconds since the
+      start, operation and path, for reads also size and offset, separated
+      by tabs. Paths are string_escape'd, file names ending in .gz are
+      compressed.
+    """
+
+    def __init__(self, fname):
+        self.f = openfile(fname, 'wb')
+        self.started = time()
+
+    def record(self, op, path, args):
+        if op not in traced:
+            return
+        line = '%.6f\t%s\t%s' % (time() - self.started, op, path.encode('string_escape'))
+        if op == 'read':
+            line += '\t%d\t%d' % (args[0], args[1])
+        self.f.write(line + '\n')
+
+    def close(self):
+        self.f.close()
+
+def readtrace(fname):
+    """ Yields (time, op, path, args) for every call in a trace file. """
+    with openfile(fname, 'rb') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            yield float(fields[0]), fields[1], fields[2].decode('string_escape'), tuple(int(x) for x in fields[3:])
+
+class MovieFSTarget(object):
+    """ Replays calls directly against a MovieFS instance. """
+
+    def __init__(self, movfs):
+        self.movfs = movfs
+
+    def __call__(self, op, path, args):
+        if op == 'getattr':
+            self.movfs('getattr', path, None)
+        elif op == 'readdir':
+            self.movfs('readdir', path, None)
+        elif op == 'readlink':
+            self.movfs('readlink', path)
+        elif op == 'read':
+            fh = self.movfs('open', path, os.O_RDONLY)
+            try:
+                self.movfs('read', path, args[0], args[1], fh)
+            finally:
+                self.movfs('release', path, fh)
+
+class MountTarget(object):
+    """ Replays calls against a mounted filesystem, through the kernel. """
+
+    def __init__(self, mountpoint):
+        self.mountpoint = mountpoint
+
+    def __call__(self, op, path, args):
+        path = self.mountpoint + path
+        if op == 'getattr':
+            os.lstat(path)
+        elif op == 'readdir':
+            os.listdir(path)
+        elif op == 'readlink':
+            os.readlink(path)
+        elif op == 'read':
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.lseek(fd, args[1], os.SEEK_SET)
+                os.read(fd, args[0])
+            finally:
+                os.close(fd)
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def replay(calls, target, workers=1):
+    """
+      Replays calls as fast as possible, in their order, on a number of
+      worker threads. Returns a dict with the number of calls and errors,
+      the elapsed time, and sorted latencies in seconds, overall and per
+      operation.
+    """
+    queue = Queue.Queue(workers * 64)
+    latencies = { }
+    errors = [ 0 ]
+    lock = threading.Lock()
+
+    def work():
+        mine = { }
+        failed = 0
+        while True:
+            call = queue.get()
+            if call is None:
+                break
+            _, op, path, args = call
+            started = time()
+            try:
+                target(op, path, args)
+            except (OSError, IOError), e:
+                # a lookup of a missing file is a perfectly normal call
+                if e.errno != ENOENT:
+                    failed += 1
+            except Exception:
+                failed += 1
+            mine.setdefault(op, [ ]).append(time() - started)
+        with lock:
+            for op, values in mine.iteritems():
+                latencies.setdefault(op, [ ]).extend(values)
+            errors[0] += failed
+
+    threads = list(threading.Thread(target=work) for i in range(workers))
+    started = time()
+    for thread in threads:
+        thread.start()
+    for call in calls:
+        queue.put(call)
+    for thread in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+    elapsed = time() - started
+
+    overall = sorted(x for values in latencies.itervalues() for x in values)
+    for values in latencies.itervalues():
+        values.sort()
+    return {
+        'calls': len(overall),
+        'errors': errors[0],
+        'elapsed': elapsed,
+        'latencies': overall,
+        'ops': latencies,
+    }
+
+def report(result):
+    lines = [ ]
+    lines.append("%d calls in %.2fs, %.0f calls/s, %d errors" % (result['calls'], result['elapsed'],
+        result['calls'] / max(result['elapsed'], 1e-9), result['errors']))
+    rows = [ ('all', result['latencies']) ] + sorted(result['ops'].items())
+    for op, values in rows:
+        if len(values) == 0:
+            continue
+        lines.append("%-9s %8d calls  p50 %8.3f ms  p99 %8.3f ms  p999 %8.3f ms  max %8.3f ms" % (op, len(values),
+            1000 * percentile(values, 0.5), 1000 * percentile(values, 0.99), 1000 * percentile(values, 0.999), 1000 * values[-1]))
+    return '\n'.join(lines)
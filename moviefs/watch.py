@@ -0,0 +1,181 @@
+import dupes
+
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import itertools
+from time import time
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+libc.inotify_init1.argtypes = [ ctypes.c_int ]
+libc.inotify_add_watch.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32 ]
+
+# from sys/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0x00080000
+
+# what directories are watched for
+mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+# struct inotify_event, followed by len bytes of name
+eventheader = struct.Struct('iIII')
+
+def oserror():
+    e = ctypes.get_errno()
+    return OSError(e, os.strerror(e))
+
+class Watcher(object):
+    """
+      Watches library roots for new video files with inotify, and hands
+      each to ingest once it is complete, that is once its size and mtime
+      did not change for settle seconds.
+
+      At most maxpending files are waited for at any time. Events beyond
+      that, and those the kernel dropped from its queue, are not lost: the
+      roots are walked again once there is room, and files the library
+      knows already are skipped. So a burst of thousands of files costs
+      memory for maxpending of them, not for the burst.
+    """
+
+    settle = 5.0
+    # how often pending files are checked, in seconds
+    interval = 1.0
+    maxpending = 10000
+
+    def __init__(self, roots, ingest, known=()):
+        self.roots = roots
+        self.ingest = ingest
+        # files in the library, or given up on, which are never looked at again
+        self.known = set(known)
+        # path -> (size, mtime, since when they are the same)
+        self.pending = { }
+        # files to look at once there is room
+        self.backlog = iter(())
+        self.missed = False
+        # watch descriptor -> directory
+        self.dirs = { }
+        self.stats = { 'events': 0, 'ingested': 0, 'failed': 0, 'rescans': 0, 'maxpending': 0 }
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise oserror()
+        for root in roots:
+            self.watchtree(root)
+        # whatever arrived while nobody was watching
+        self.rescan()
+
+    def watchtree(self, top):
+        for dirpath, dirnames, filenames in os.walk(top):
+            wd = libc.inotify_add_watch(self.fd, dirpath, mask)
+            if wd < 0:
+                e = oserror()
+                if e.errno == errno.ENOSPC:
+                    print "error: out of inotify watches, raise fs.inotify.max_user_watches"
+                if e.errno != errno.ENOENT:
+                    raise e
+                continue
+            self.dirs[wd] = dirpath
+
+    def rescan(self, tops=None):
+        """ Looks at all files below tops, by default all roots, as they fit into pending. """
+        self.stats['rescans'] += 1
+        self.backlog = itertools.chain(self.backlog, dupes.libraryfiles(tops or self.roots))
+        if tops is None:
+            self.missed = False
+
+    def add(self, path):
+        if path in self.known or path in self.pending:
+            return
+        if len(self.pending) >= self.maxpending:
+            self.missed = True
+            return
+        self.pending[path] = (None, None, 0)
+        self.stats['maxpending'] = max(self.stats['maxpending'], len(self.pending))
+
+    def readevents(self):
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, flags, cookie, length = eventheader.unpack_from(data, offset)
+                name = data[offset + eventheader.size:offset + eventheader.size + length].rstrip('\0')
+                offset += eventheader.size + length
+                self.stats['events'] += 1
+                self.event(wd, flags, name)
+
+    def event(self, wd, flags, name):
+        if flags & IN_Q_OVERFLOW:
+            self.missed = True
+            return
+        if flags & IN_IGNORED:
+            self.dirs.pop(wd, None)
+            return
+        if wd not in self.dirs:
+            return
+        path = os.path.join(self.dirs[wd], name)
+        if flags & IN_ISDIR:
+            # a directory moved in may have files already
+            self.watchtree(path)
+            self.rescan([ path ])
+        elif os.path.splitext(name)[1].lower() in dupes.extensions:
+            self.add(path)
+
+    def check(self):
+        """ Hands complete files to ingest, and refills pending from the backlog. """
+        now = time()
+        for path, (size, mtime, since) in self.pending.items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                # gone again, like a temporary file
+                del self.pending[path]
+                continue
+            if (st.st_size, st.st_mtime) != (size, mtime):
+                self.pending[path] = (st.st_size, st.st_mtime, now)
+            elif now - since >= self.settle:
+                del self.pending[path]
+                self.known.add(path)
+                try:
+                    self.ingest(path)
+                    self.stats['ingested'] += 1
+                except Exception, e:
+                    # one bad file must not end the watch
+                    print "error: could not add", path, "-", e
+                    self.stats['failed'] += 1
+
+        while len(self.pending) < self.maxpending:
+            path = next(self.backlog, None)
+            if path is None:
+                break
+            self.add(path)
+        if self.missed and len(self.pending) < self.maxpending:
+            self.rescan()
+
+    def run(self, until=None):
+        """ Watches forever, or until the function until returns True. """
+        checked = 0
+        while until is None or not until():
+            readable, _, _ = select.select([ self.fd ], [ ], [ ], self.interval)
+            if readable:
+                self.readevents()
+            if time() - checked >= self.interval:
+                self.check()
+                checked = time()
+
+    def close(self):
+        os.close(self.fd)
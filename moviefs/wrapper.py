@@ -1,19 +1,76 @@
-import db
-import moviefs
-
-import tmdb
+# everything else is imported by the modes that need it, to keep startup fast
 import os
 import sys
+import json
 
 import argparse
 
+# the library root if none are given, and that of movies recorded without one
 pathbase = '/home/shared/hd/'
 
+def opendb(args, readonly=False):
+    """ Imports the database module, set up for the database chosen on the command line. """
+    import db
+    db.configure(args.database, readonly)
+    return db
+
 def mode_init(args):
-    db.init()
+    db = opendb(args)
+    db.init(os.path.abspath(args.root[0]).decode('utf-8'))
+
+def libraryroot(fname, roots):
+    """ The root of roots that fname lies below, or the first one. """
+    fname = os.path.abspath(fname)
+    for root in sorted(roots, key=len, reverse=True):
+        if fname.startswith(os.path.join(os.path.abspath(root), '')):
+            return os.path.abspath(root)
+    return os.path.abspath(roots[0])
+
+def ingest(info, downloader, roots):
+    """ Adds a probed file to the database, as the tmdb search result chosen in info['movie']. """
+    import db
+    import tmdb
+    print "Width:", info['attrs']['ID_VIDEO_WIDTH'], "Height:", info['attrs']['ID_VIDEO_HEIGHT']
+    info['movie'] =  info['movie'].info()
+    if 'genre' not in info['movie']['categories']:
+        info['movie']['categories']['genre'] = { }
+    if 'actor' not in info['movie']['cast']:
+        info['movie']['cast']['actor'] = { }
+    info['languages'] = tmdb.audiolanguages(info['attrs'])
+    # for key in info['movie']:
+        # print key, ": ", info['movie'][key]
+    root = db.Root.get_or_create(libraryroot(info['fname'], roots).decode('utf-8'))
+    db.session.flush()
+    movie = db.Movie.get_or_create(info['movie']['id'], os.path.relpath(info['fname'], root.path.encode('utf-8')), info, root.id)
+    db.session.commit()
+    if downloader is not None:
+        downloader.add(movie.id, info['movie']['images'])
+    return movie
+
+def queuereview(fname, info):
+    """ Leaves a file without a confident match for the review mode. """
+    import db
+    candidates = list(dict((k, v) for k, v in x.iteritems() if k != 'images') for x in info['movie'])
+    db.Review.set(os.path.abspath(fname).decode('utf-8'), info['guessname'], info['attrs'], candidates)
+    db.session.commit()
+
+def finishdownloads(downloader):
+    if downloader is not None:
+        print "waiting for artwork downloads.."
+        print downloader.finish(), "images in store"
+        for url, e in downloader.errors:
+            print "error: could not download", url, "-", e
 
 def mode_add(args):
+    db = opendb(args)
+    import tmdb
+    import artwork
+    import titleindex
+
+    downloader = artwork.Downloader(args.artwork) if args.artwork else None
+    tmdb.localindex = titleindex.TitleIndex.load()
 
+    queued = 0
     i = 1
     for fname in args.file:
 
@@ -27,35 +84,271 @@ def mode_add(args):
             print "error: file not found!"
             continue
 
-        info = tmdb.findmovieinfo(fname)
+        info = tmdb.findmovieinfo(fname, not args.batch)
+
+        # not sure which movie this is? leave it for a review.
+        if args.batch and info is not None and not isinstance(info['movie'], tmdb.MovieResult):
+            queuereview(fname, info)
+            print "no confident match, queued for review"
+            queued += 1
+            continue
 
         # no name? skip.
         if info is None or len(info['movie']) == 0:
             print "skipping file.."
-            break
+            continue
 
         else:
-            print "Width:", info['attrs']['ID_VIDEO_WIDTH'], "Height:", info['attrs']['ID_VIDEO_HEIGHT']
-            info['movie'] =  info['movie'].info()
-            if 'genre' not in info['movie']['categories']:
-                info['movie']['categories']['genre'] = { }
-            if 'actor' not in info['movie']['cast']:
-                info['movie']['cast']['actor'] = { }
-            # for key in info['movie']:
-                # print key, ": ", info['movie'][key]
-            movie = db.Movie.get_or_create(info['movie']['id'], os.path.relpath(fname, pathbase), info)
+            ingest(info, downloader, args.root)
+
+    finishdownloads(downloader)
+    print "title searches: %(local)d answered locally, %(remote)d on tmdb" % tmdb.localindex.stats
+    if queued > 0:
+        print queued, "files queued, resolve them with the review mode"
+
+def mode_review(args):
+    db = opendb(args)
+    import tmdb
+    import artwork
+
+    downloader = artwork.Downloader(args.artwork) if args.artwork else None
+
+    for review in db.session.query(db.Review).order_by(db.Review.added).all():
+
+        print
+        print "filename: ", review.path
+
+        if not os.access(review.path, os.F_OK):
+            print "error: file not found, dropping it from the queue"
+            db.session.delete(review)
             db.session.commit()
+            continue
+
+        info = {
+            'fname': review.path.encode('utf-8'),
+            'guessname': review.guessname,
+            'attrs': json.loads(review.attrs),
+            'movie': tmdb.SearchResults(tmdb.MovieResult(x) for x in json.loads(review.candidates)),
+        }
+
+        while True:
+            candidates = sorted(((tmdb.scorecandidate(info, x), x) for x in info['movie']), reverse=True)
+            print "Candidates for '%s':" % info['guessname']
+            for i in range(0, len(candidates)):
+                print " ", i+1, "-", unicode(candidates[i][1]), "(score %.2f)" % candidates[i][0]
+            if len(candidates) == 0:
+                print "  none, edit the title to search again"
+                selection = raw_input("(e)dit, (s)kip or (d)rop: ")
+            else:
+                selection = raw_input("Select by number (1-" + str(len(candidates)) + "), (e)dit, (s)kip or (d)rop: ")
+            if selection == 's':
+                break
+            if selection == 'd':
+                db.session.delete(review)
+                db.session.commit()
+                break
+            if selection == 'e':
+                guessname = raw_input("Input Title: ")
+                if guessname != '':
+                    info['guessname'] = guessname.decode('utf-8')
+                    info['movie'] = tmdb.search(info['guessname'])
+                continue
+            try:
+                selection = int(selection)
+            except ValueError:
+                print "Value error!"
+                continue
+            if selection > 0 and selection <= len(candidates):
+                info['movie'] = candidates[selection-1][1]
+                ingest(info, downloader, args.root)
+                db.session.delete(review)
+                db.session.commit()
+                break
+
+    finishdownloads(downloader)
+
+def mode_dupes(args):
+    db = opendb(args)
+    import dupes
+
+    if len(args.file) > 0:
+        paths = dupes.libraryfiles(args.file)
+    else:
+        paths = list(db.moviePath(x, args.root[0]).encode('utf-8') for x in db.session.query(db.Movie))
+
+    found = dupes.find(paths, args.jobs)
+    for size, group in found:
+        print
+        print "%.2f GiB, %d copies:" % (size / 1024.0**3, len(group))
+        for path in group:
+            print " -", path
+    print
+    print "%d groups of duplicates, %.2f GiB reclaimable" % (len(found), sum(size * (len(group) - 1) for size, group in found) / 1024.0**3)
+
+def mode_refresh(args):
+    db = opendb(args)
+    import tmdb
+    import refresh
+
+    tmdb.limiter = tmdb.RateLimiter(args.rate, max(1, int(args.rate)))
+    movies = refresh.stale(args.days)
+    print len(movies), "movies not refreshed in", args.days, "days"
+
+    changed, stats = refresh.refresh(movies, args.jobs)
+    for movie, changes in changed:
+        print
+        print movie.name
+        for change in changes:
+            print " -", change
+    for movie, error in stats['errors']:
+        print "error: could not refresh", movie.name, "(id %d) -" % movie.id, error
+    print
+    print "%d changed, %d unchanged, %d not modified, %d errors" % (stats['changed'], stats['unchanged'], stats['notmodified'], len(stats['errors']))
+
+def mode_organize(args):
+    db = opendb(args)
+    import tmdb
+    import organize
+
+    organize.sampled = args.sampled_verify
+    # files are moved into the first root
+    root = db.Root.get_or_create(os.path.abspath(args.root[0]).decode('utf-8'))
+    db.session.commit()
+    tmdb.path_base = os.path.join(root.path.encode('utf-8'), '')
+
+    journal = organize.Journal(args.database + '.organize')
+    pending = journal.load()
+    if len(pending) > 0:
+        print len(pending), "unfinished moves from an earlier run"
+
+    movies = db.session.query(db.Movie).all()
+    if len(args.file) > 0:
+        wanted = set(os.path.abspath(x) for x in args.file)
+        movies = list(x for x in movies if os.path.abspath(db.moviePath(x, args.root[0]).encode('utf-8')) in wanted)
+    resumed = set(x['id'] for x in pending)
+    moves, conflicts = organize.plan(list(x for x in movies if x.id not in resumed), args.root[0])
+    for movie, reason in conflicts:
+        print "conflict:", movie.name, "-", reason
+    moves = pending + moves
+
+    if args.dry_run:
+        for move in moves:
+            print "mv:", move['src'], "->", move['dst']
+        print len(moves), "files to move,", len(conflicts), "conflicts"
+        return
+
+    journal.start(moves)
+    failed = 0
+    for move, method, error in organize.run(moves, root, journal, args.jobs):
+        if error is not None:
+            print "error:", move['src'], "-", error
+            failed += 1
+        else:
+            print "mv:", move['src'], "->", move['dst'], "(%s)" % method
+    journal.close()
+    print len(moves) - failed, "files moved,", failed, "failed,", len(conflicts), "conflicts"
+    if failed > 0:
+        print "run organize again to retry the failed moves"
+
+def mode_watch(args):
+    db = opendb(args)
+    import tmdb
+    import artwork
+    import titleindex
+    import watch
+
+    downloader = artwork.Downloader(args.artwork) if args.artwork else None
+    tmdb.localindex = titleindex.TitleIndex.load()
+
+    def add(fname):
+        print
+        print "filename: ", fname
+        info = tmdb.findmovieinfo(fname, False)
+        if info is not None and isinstance(info['movie'], tmdb.MovieResult):
+            ingest(info, downloader, args.root)
+        elif info is not None:
+            queuereview(fname, info)
+            print "no confident match, queued for review"
+
+    known = set(os.path.abspath(db.moviePath(x, args.root[0])).encode('utf-8') for x in db.session.query(db.Movie))
+    known.update(x[0].encode('utf-8') for x in db.session.query(db.Review.path))
+    watcher = watch.Watcher(list(os.path.abspath(x) for x in args.root), add, known)
+    print "watching", ', '.join(args.root)
+    try:
+        watcher.run()
+    finally:
+        watcher.close()
+        finishdownloads(downloader)
+
+def mode_export(args):
+    db = opendb(args, readonly=True)
+    import snapshot
+
+    counts = snapshot.export(args.file[0])
+    print "exported", ', '.join('%d %s' % (counts[x], x) for x in snapshot.tables)
+
+def mode_import(args):
+    import snapshot
+    from time import time
+
+    db = opendb(args)
+    started = time()
+    try:
+        counts, dropped = snapshot.restore(args.file[0])
+    except snapshot.SnapshotError, e:
+        print "error:", e
+        sys.exit(1)
+    for column in dropped:
+        print "left out column", column, "which the database no longer has"
+    print "imported", ', '.join('%d %s' % (counts[x], x) for x in snapshot.tables if x in counts), "in %.1fs" % (time() - started)
 
 def mode_mount(args):
-    moviefs.mount(args.file[0], pathbase, db.session)
+    # the mount never writes, and must not get in the way of an ingest
+    db = opendb(args, readonly=True)
+    import moviefs
+
+    moviefs.mount(args.file[0], args.root[0], db.session, args.prefetch, args.passthrough, args.profile, args.artwork, args.inodes, args.trace)
+    if args.prefetch > 0:
+        stats = db.prefetch_stats
+        print "prefetch: %(queued)d listings queued, %(dropped)d dropped, %(prefetched)d movies loaded in %(batches)d batches" % stats
+        print "prefetch: %d hits, %.1f%% of all movie lookups" % (stats['hits'], 100.0 * stats['hits'] / max(1, db.movie_cache_stats['hits'] + db.movie_cache_stats['misses']))
+
+def mode_replay(args):
+    import traces
+
+    if len(args.file) > 1:
+        target = traces.MountTarget(args.file[1].rstrip('/'))
+    else:
+        db = opendb(args, readonly=True)
+        import moviefs
+        target = traces.MovieFSTarget(moviefs.MovieFS(args.root[0], db.session))
+
+    calls = list(traces.readtrace(args.file[0]))
+    print traces.report(traces.replay(calls, target, args.jobs))
 
 def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', help='turn on verbose output to stderr')
+    parser.add_argument('-d', '--database', default='movies.db', help='the movie database file, default: movies.db')
+    parser.add_argument('-r', '--root', action='append', metavar='DIR', help='a library root, may be given several times. add records files relative to the root they are in, organize moves files into the first one, and movies recorded without a root are below it, init records them so. default: ' + pathbase)
+    parser.add_argument('--prefetch', type=int, default=0, metavar='DEPTH', help='mount: load movies of listed directories in the background, keeping at most DEPTH listings queued')
+    parser.add_argument('--passthrough', action='store_true', help='mount: expose videos as regular files read through the mount, instead of symlinks')
+    parser.add_argument('--profile', metavar='DIR', help='mount: toggle profiling with SIGUSR1, profiles are written to DIR')
+    parser.add_argument('--artwork', metavar='DIR', help='add: download posters and fanart into the store at DIR, mount: serve them from there')
+    parser.add_argument('--inodes', action='store_true', help='mount: use stable inode numbers derived from database ids')
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='dupes: number of files to hash and compare in parallel, replay: number of concurrent workers, refresh: number of concurrent tmdb requests, organize: number of source devices copied from in parallel')
+    parser.add_argument('--trace', metavar='FILE', help='mount: record all lookups and reads to FILE, for the replay mode')
+    parser.add_argument('--days', type=int, default=30, help='refresh: refetch movies whose info is older than this, default: 30')
+    parser.add_argument('--rate', type=float, default=3, help='refresh: at most this many tmdb requests per second, default: 3')
+    parser.add_argument('-n', '--dry-run', action='store_true', help='organize: only show the planned moves')
+    parser.add_argument('--sampled-verify', action='store_true', help='organize: check copies by size and opensubtitles hash only, instead of comparing them in full before the source is removed')
+    parser.add_argument('--batch', action='store_true', help='add: never ask, queue files without a confident match for the review mode')
     # parser.add_argument('mode', type=complex, choices=[ 'init', 'add' ], help='work mode')
     parser.add_argument('file', nargs='*', help='movie files')
     args = parser.parse_args()
+    if args.root is None:
+        args.root = [ pathbase ]
 
     mode = args.file[0]
     args.file = args.file[1:]
@@ -65,6 +358,22 @@ def main():
         mode_mount(args)
     elif mode == 'init':
         mode_init(args)
+    elif mode == 'review':
+        mode_review(args)
+    elif mode == 'dupes':
+        mode_dupes(args)
+    elif mode == 'replay':
+        mode_replay(args)
+    elif mode == 'refresh':
+        mode_refresh(args)
+    elif mode == 'organize':
+        mode_organize(args)
+    elif mode == 'watch':
+        mode_watch(args)
+    elif mode == 'export':
+        mode_export(args)
+    elif mode == 'import':
+        mode_import(args)
 
 if __name__ == '__main__':
     main()